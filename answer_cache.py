@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from pymongo import ReturnDocument
+
+from database import mongo_db
+
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # min cosine similarity
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+ANSWER_CACHE_MAX_PER_USER = int(os.getenv("ANSWER_CACHE_MAX_PER_USER", "200"))
+
+# Version of each user's document set, {"_id": user_id, "version": n}; shared by every API
+# worker so an upload or delete handled by one worker invalidates the others' answers
+document_versions = mongo_db.document_versions
+
+
+class _UserAnswers:
+    def __init__(self, version: int):
+        self.version = version
+        self.entries: "OrderedDict[int, tuple]" = OrderedDict()  # entry id -> (unit vector, answer)
+        self.matrix: Optional[np.ndarray] = None
+        self.ids: List[int] = []
+
+    def similarity_matrix(self):
+        if self.matrix is None:
+            self.ids = list(self.entries)
+            self.matrix = np.stack([self.entries[i][0] for i in self.ids]) if self.ids else None
+        return self.ids, self.matrix
+
+
+class SemanticAnswerCache:
+    """Per-user cache of LLM answers, looked up by query-embedding similarity.
+
+    Entries belong to a version of the user's document set; bump_version() on every
+    upload or delete makes all of that user's answers unreachable. Versions live in
+    Mongo: version() reads the current one before each lookup, so every worker drops
+    its stale answers. Eviction is LRU, both per user and across the whole cache.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_per_user: int = ANSWER_CACHE_MAX_PER_USER):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_per_user = max_per_user
+        self.hits = 0
+        self.misses = 0
+        self._versions: Dict[str, int] = {}
+        self._users: Dict[str, _UserAnswers] = {}
+        self._lru: "OrderedDict[tuple, None]" = OrderedDict()  # (user_id, entry id), oldest first
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _user(self, user_id: str, create: bool = True) -> Optional[_UserAnswers]:
+        version = self._versions.get(user_id, 0)
+        answers = self._users.get(user_id)
+        if answers is not None and answers.version != version:
+            for entry_id in answers.entries:
+                self._lru.pop((user_id, entry_id), None)
+            del self._users[user_id]
+            answers = None
+        if answers is None and create:
+            answers = self._users[user_id] = _UserAnswers(version)
+        return answers
+
+    def _evict(self, user_id: str, entry_id: int):
+        self._lru.pop((user_id, entry_id), None)
+        answers = self._users.get(user_id)
+        if answers is not None and answers.entries.pop(entry_id, None) is not None:
+            answers.matrix = None
+            if not answers.entries:
+                del self._users[user_id]
+
+    def lookup(self, user_id: str, embedding: List[float]) -> Optional[str]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            answers = self._user(user_id, create=False)
+            ids, matrix = answers.similarity_matrix() if answers is not None else (None, None)
+            if matrix is not None:
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry_id = ids[best]
+                    answers.entries.move_to_end(entry_id)
+                    self._lru.move_to_end((user_id, entry_id))
+                    self.hits += 1
+                    return answers.entries[entry_id][1]
+            self.misses += 1
+            return None
+
+    async def store(self, user_id: str, embedding: List[float], answer: str, version: Optional[int] = None):
+        """Cache an answer; pass the version read before retrieval so an answer built from a
+        document set that changed meanwhile (on any worker) is dropped instead of cached."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        await self.version(user_id)
+        with self._lock:
+            answers = self._user(user_id)
+            if version is not None and version != answers.version:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            answers.entries[entry_id] = (vector, answer)
+            answers.matrix = None
+            self._lru[(user_id, entry_id)] = None
+            while len(answers.entries) > self.max_per_user:
+                self._evict(user_id, next(iter(answers.entries)))
+            while len(self._lru) > self.max_entries:
+                self._evict(*next(iter(self._lru)))
+
+    def _set_version(self, user_id: str, version: int):
+        with self._lock:
+            # Versions only grow; a slower concurrent read must not roll one back
+            if version > self._versions.get(user_id, 0):
+                self._versions[user_id] = version
+                self._user(user_id, create=False)
+
+    async def version(self, user_id: str) -> int:
+        """Current version of the user's document set; drops local answers of older ones."""
+        doc = await document_versions.find_one({"_id": user_id})
+        version = doc["version"] if doc else 0
+        self._set_version(user_id, version)
+        return version
+
+    async def bump_version(self, user_id: str):
+        """The user's documents changed: every cached answer of theirs is stale, on every worker."""
+        doc = await document_versions.find_one_and_update(
+            {"_id": user_id}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        self._set_version(user_id, doc["version"])
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "users": len(self._users),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+answer_cache = SemanticAnswerCache()
@@ -1,32 +1,38 @@
-from datetime import datetime
-from http.client import HTTPException
+import asyncio
 import json
 import os
-import shutil
 import traceback
 from typing import List
-from uuid import uuid4
 
-from chat_memory import add_to_history, clear_user_history, get_user_history
-from database import create_token, hash_password, verify_password, mongo_db, get_user_id_from_token
-from fastapi import FastAPI, UploadFile, Form, Query
+from chat_memory import add_exchange, clear_user_history, get_user_history
+from database import create_token, ensure_indexes, hash_password_async, verify_password_async, mongo_db, get_user_id_from_token
+from pymongo.errors import DuplicateKeyError
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import UploadFile, File, Form, Depends
 
 
-from file_store import store_metadata
-from openai import OpenAI
+from openai import AsyncOpenAI
 
-from extract_chunks import extract_chunks_from_pdf
-from qdrant_store import summarize_chunks, upsert_chunks, search_chunks, list_documents, handle_delete_file, upsert_chunks_async, search_across_reports
-from llm_prompter import build_prompt, build_prompt_beta
+from answer_cache import answer_cache
+from file_store import FILES_PAGE_SIZE, delete_metadata, ensure_file_indexes, list_metadata
+from ingest_jobs import create_job, ensure_job_indexes, get_job, shutdown_parse_pool
+from lab_store import delete_lab_results, ensure_lab_indexes, load_lab_results, load_series, user_test_keys
+from qdrant_store import embedding_cache, embedding_provider, get_query_embedding, group_by_report, init_collection, search_chunk_hits, handle_delete_file
+from llm_prompter import build_prompt, build_prompt_beta, build_prompt_trends, count_tokens, format_series_table, pack_context
+from report_summarizer import evaluate_tests, most_abnormal
+from structured_parser import find_named_tests, find_tests_by_word
+from summary_store import save_structured_summary
+from query_cache import query_embedding_cache
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")  # or gpt-4 / gpt-4o
-META_DIR = "storage/metadata"
+SUMMARY_ABNORMAL_LIMIT = int(os.getenv("SUMMARY_ABNORMAL_LIMIT", "10"))
+TREND_MAX_TESTS = int(os.getenv("TREND_MAX_TESTS", "12"))  # test series sent for one /beta/query question
+TREND_WORD_MAX_TESTS = int(os.getenv("TREND_WORD_MAX_TESTS", "4"))  # more word-only matches is too ambiguous to use
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 app = FastAPI(title="Medical RAG POC", version="1.0.0")
 
@@ -38,25 +44,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup():
+    # Verify the Qdrant collection once so requests don't pay a get_collections round trip
+    await init_collection()
+    await ensure_indexes()
+    await ensure_lab_indexes()
+    await ensure_file_indexes()
+    await ensure_job_indexes()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await embedding_provider.aclose()
+    shutdown_parse_pool()
+
 @app.post("/register/")
 async def register(username: str = Form(...), email: str = Form(...), password: str = Form(...)):
-    if await mongo_db.users.find_one({"username": username}):
+    if await mongo_db.users.find_one({"username": username}, {"_id": 1}):
         raise HTTPException(400, "User already exists")
 
-    hashed = hash_password(password)
-    await mongo_db.users.insert_one({
-        "username": username,
-        "email": email,
-        "hashed_password": hashed
-    })
+    hashed = await hash_password_async(password)
+    try:
+        await mongo_db.users.insert_one({
+            "username": username,
+            "email": email,
+            "hashed_password": hashed
+        })
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration of the same name
+        raise HTTPException(400, "User already exists")
 
     return {"message": "User registered successfully"}
 
 @app.post("/login/")
 async def login(username: str = Form(...), password: str = Form(...)):
-    user = await mongo_db.users.find_one({"username": username})
-    print(user)
-    if not user or not verify_password(password, user["hashed_password"]):
+    user = await mongo_db.users.find_one({"username": username}, {"username": 1, "hashed_password": 1})
+    if not user or not await verify_password_async(password, user["hashed_password"]):
         raise HTTPException(401, "Invalid credentials")
 
     token = create_token({"sub": username})
@@ -69,142 +92,237 @@ async def upload_multiple(
     files: List[UploadFile] = File(...),
     user_id: str = Depends(get_user_id_from_token)
 ):
-    results = []
-    mongo_file_docs = []
-    for file in files:
-        try:
-            patient_id = file.filename
-
-            tmp_path = f"/tmp/{uuid4().hex}_{file.filename}"
-            with open(tmp_path, "wb") as f:
-                shutil.copyfileobj(file.file, f)
-
-            chunks, _ = extract_chunks_from_pdf(tmp_path)
-            os.remove(tmp_path)
-
-            if not chunks:
-                results.append({
-                    "filename": file.filename,
-                    "status": "failed",
-                    "error": "No text chunks extracted."
-                })
-                continue
-
-            upsert_chunks(
-                patient_id=patient_id,
-                filename=file.filename,
-                chunks=chunks,
-                user_id=user_id
-            )
-            # summary = summarize_chunks(chunks)
-            store_metadata(user_id=user_id, filename=file.filename, num_chunks=len(chunks), summary="")
-            results.append({
-                "filename": file.filename,
-                "status": "indexed",
-                "num_chunks": len(chunks),
-                "timestamp": datetime.utcnow(),
-            })
-            # Collect metadata for batch insert
-            mongo_file_docs.append({
-                "filename": file.filename,
-                "user_id": user_id,
-                "timestamp": datetime.utcnow(),
-                "num_chunks": len(chunks)
-            })
-
-        except Exception as e:
-            results.append({
-                "filename": file.filename,
-                "status": "error",
-                "error": str(e)
-            })
-
-    # Batch insert all file metadata at once (if any)
-    if mongo_file_docs:
-        await mongo_db.files.insert_many(mongo_file_docs)
-
-    return {"uploads": results}
+    # Read the uploads before responding; parsing, embedding and indexing run in the background
+    uploads = [(file.filename, await file.read()) for file in files]
+    job = await create_job(user_id, uploads)
+    return {"job_id": job["job_id"], "status": job["status"], "files": job["files"]}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, user_id: str = Depends(get_user_id_from_token)):
+    job = await get_job(job_id, user_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+        "files": job["files"],
+    }
+
+
+NO_CONTEXT_ANSWER = "No relevant context found for your question in this report."
+NO_CONTEXT_ANSWER_BETA = "No relevant context found across your reports."
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_answer(messages: list, on_complete=None, context_tokens: int = 0):
+    """Forward completion tokens as Server-Sent Events, then call on_complete with the full answer."""
+    try:
+        stream = await client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=0.0,
+            stream=True,
+        )
+        parts = []
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield sse_event("token", {"token": delta})
+        answer = "".join(parts)
+        if on_complete:
+            await on_complete(answer)
+        yield sse_event("done", {"answer": answer, "context_tokens": context_tokens})
+    except Exception as e:
+        traceback.print_exc()
+        yield sse_event("error", {"error": str(e)})
+
+
+async def single_event_stream(answer: str):
+    yield sse_event("done", {"answer": answer})
+
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def build_query_messages(question: str, user_id: str, history: list):
+    hits, context_tokens = pack_context(await search_chunk_hits(question, 5, user_id))
+    if not hits:
+        return None, 0
+    prompt = build_prompt(question, [hit["text"] for hit in hits])
+    return history + [{"role": "user", "content": prompt}], context_tokens
+
+
+async def cached_answer(question: str, user_id: str, history: list):
+    """Answer of an earlier, semantically equivalent question against the same documents.
+
+    Only questions asked without earlier turns use the cache: with a history the answer
+    depends on the conversation, not just the question. Returns (embedding, document-set
+    version, answer); the embedding is None when the answer must not be cached.
+    """
+    if history:
+        return None, None, None
+    version = await answer_cache.version(user_id)
+    embedding = await get_query_embedding(question)
+    return embedding, version, answer_cache.lookup(user_id, embedding)
 
 
 @app.post("/query/")
 async def query(question: str = Form(...), user_id: str = Depends(get_user_id_from_token)):
     try:
-        chunks = search_chunks(question, 5, user_id)
+        history = await get_user_history(user_id)
+        embedding, version, answer = await cached_answer(question, user_id, history)
+        if answer is not None:
+            await add_exchange(user_id, question, answer)
+            return {"answer": answer, "cached": True}
 
-        if not chunks:
-            return {"answer": "No relevant context found for your question in this report."}
+        full_messages, context_tokens = await build_query_messages(question, user_id, history)
 
-        prompt = build_prompt(question, chunks)
-        full_messages = get_user_history(user_id).copy()
-        full_messages.append({"role": "user", "content": prompt})
+        if not full_messages:
+            return {"answer": NO_CONTEXT_ANSWER}
 
-
-        resp = client.chat.completions.create(
+        resp = await client.chat.completions.create(
             model=CHAT_MODEL,
             messages=full_messages,
             temperature=0.0,
         )
 
         answer = resp.choices[0].message.content
-        add_to_history(user_id, "user", prompt)
-        add_to_history(user_id, "assistant", answer)
+        await add_exchange(user_id, question, answer)
+        if embedding is not None:
+            await answer_cache.store(user_id, embedding, answer, version)
 
-        return {"answer": answer}
+        return {"answer": answer, "context_tokens": context_tokens}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
-@app.get("/list_documents/")
-async def list_reports(user_id: str = Depends(get_user_id_from_token)):
+@app.post("/query/stream")
+async def query_stream(question: str = Form(...), user_id: str = Depends(get_user_id_from_token)):
     try:
-        # Fetch all files for the user from MongoDB
-        files_cursor = mongo_db.files.find({"user_id": user_id})
-        files = []
-        async for file in files_cursor:
-            file["_id"] = str(file["_id"])  # Convert ObjectId to string if needed
-            files.append(file)
-        return {"files": files}
+        history = await get_user_history(user_id)
+        embedding, version, answer = await cached_answer(question, user_id, history)
+        if answer is None:
+            full_messages, context_tokens = await build_query_messages(question, user_id, history)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-from structured_parser import extract_structured_tests
-from summary_store import save_structured_summary, load_structured_summary
+    if answer is not None:
+        await add_exchange(user_id, question, answer)
+        return sse_response(single_event_stream(answer))
+
+    if not full_messages:
+        return sse_response(single_event_stream(NO_CONTEXT_ANSWER))
+
+    async def save_history(answer: str):
+        await add_exchange(user_id, question, answer)
+        if embedding is not None:
+            await answer_cache.store(user_id, embedding, answer, version)
+
+    return sse_response(stream_answer(full_messages, on_complete=save_history, context_tokens=context_tokens))
+
+
+@app.get("/cache_stats/")
+async def cache_stats(user_id: str = Depends(get_user_id_from_token)):
+    return {
+        "answers": answer_cache.stats(),
+        "query_embeddings": query_embedding_cache.stats(),
+        "embeddings": embedding_cache.stats(),
+    }
+
+
+@app.get("/list_documents/")
+async def list_reports(
+    cursor: str = Query(None),
+    limit: int = Query(FILES_PAGE_SIZE),
+    user_id: str = Depends(get_user_id_from_token)
+):
+    try:
+        files, next_cursor = await list_metadata(user_id, cursor, limit)
+        return {"files": files, "next_cursor": next_cursor}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.post("/summary/")
 async def get_summary(session_id: str = Form(...), user_id: str = Form(...)):
     try:
-        chunks = search_chunks(query="summary", top_k = 10, user_id=user_id)
-
-        full_text = "\n".join(chunks)
-        summary = extract_structured_tests(full_text)
-        save_structured_summary(user_id, session_id, summary)
-        return {"summary": summary}
+        # Results were extracted once at ingest; this is an indexed read over every report
+        summary = await load_lab_results(user_id)
+        abnormal = most_abnormal(summary, evaluate_tests(summary), limit=SUMMARY_ABNORMAL_LIMIT)
+        await asyncio.to_thread(save_structured_summary, user_id, session_id, summary)
+        return {"summary": summary, "abnormal": abnormal}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.post("/delete_file/")
 async def delete_file(user_id: str = Depends(get_user_id_from_token), filename: str = Form(...)):
     await handle_delete_file(user_id=user_id, filename=filename)
-    clear_user_history(user_id)
+    await delete_lab_results(user_id, filename)
+    await delete_metadata(user_id, filename)
+    await answer_cache.bump_version(user_id)
+    await clear_user_history(user_id)
     return {"status": "deleted"}
 
+async def build_beta_messages(question: str, user_id: str):
+    test_keys = await user_test_keys(user_id)
+    # Questions naming tests in full get their complete history from the lab time series
+    named = find_named_tests(question, test_keys)[:TREND_MAX_TESTS]
+    if named:
+        table = format_series_table(await load_series(user_id, named))
+        return [{"role": "user", "content": build_prompt_trends(question, table)}], count_tokens(table)
+
+    hits, context_tokens = pack_context(await search_chunk_hits(question, top_k=15, user_id=user_id))
+    # A shared word ("cholesterol") is a weaker match: send those histories next to the retrieved chunks
+    related = find_tests_by_word(question, test_keys)
+    if related and len(related) <= TREND_WORD_MAX_TESTS:
+        table = format_series_table(await load_series(user_id, related))
+        prompt = build_prompt_trends(question, table, group_by_report(hits))
+        return [{"role": "user", "content": prompt}], count_tokens(table) + context_tokens
+    if not hits:
+        return None, 0
+    prompt = build_prompt_beta(question, group_by_report(hits))
+    return [{"role": "user", "content": prompt}], context_tokens
+
+
 @app.post("/beta/query")
 async def beta_query(question: str = Form(...), user_id: str = Depends(get_user_id_from_token)):
     try:
-        grouped_chunks = search_across_reports(question, top_k=15, user_id=user_id)
-
-        if not grouped_chunks:
-            return {"answer": "No relevant context found across your reports."}
+        messages, context_tokens = await build_beta_messages(question, user_id)
 
-        prompt = build_prompt_beta(question, grouped_chunks)
+        if not messages:
+            return {"answer": NO_CONTEXT_ANSWER_BETA}
 
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=CHAT_MODEL,
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             temperature=0
         )
 
-        return {"answer": response.choices[0].message.content}
+        return {"answer": response.choices[0].message.content, "context_tokens": context_tokens}
 
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@app.post("/beta/query/stream")
+async def beta_query_stream(question: str = Form(...), user_id: str = Depends(get_user_id_from_token)):
+    try:
+        messages, context_tokens = await build_beta_messages(question, user_id)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    if not messages:
+        return sse_response(single_event_stream(NO_CONTEXT_ANSWER_BETA))
+
+    return sse_response(stream_answer(messages, context_tokens=context_tokens))
@@ -0,0 +1,132 @@
+"""Recall, latency and memory of the vector storage layouts.
+
+Compares the current layout (full float32 vectors in RAM) with reduced-dimension
+vectors, with and without int8 quantization plus rescoring. Vectors come from the
+live collection (or a .npy file of full-size embeddings). Queries are held out of
+the indexed set, and ground truth is exact cosine top-k on the full vectors.
+text-embedding-3 vectors shortened by the API are their first `d` components
+renormalized, so reduced layouts are simulated by truncating the same vectors.
+
+    python -m benchmarks.compare_vector_storage --limit 20000 --dims 1536 512 256
+    python -m benchmarks.compare_vector_storage --vectors embeddings.npy --url http://localhost:6333
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    Distance,
+    HnswConfigDiff,
+    OptimizersConfigDiff,
+    PointStruct,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+)
+
+QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
+COLLECTION = os.getenv("QDRANT_COLLECTION", "medical_reports")
+
+
+def load_vectors(args) -> np.ndarray:
+    if args.vectors:
+        vectors = np.load(args.vectors).astype(np.float32)
+    else:
+        client = QdrantClient(location=args.url)
+        rows, offset = [], None
+        while len(rows) < args.limit:
+            points, offset = client.scroll(COLLECTION, limit=1000, offset=offset, with_payload=False, with_vectors=True)
+            rows.extend(p.vector for p in points)
+            if offset is None:
+                break
+        vectors = np.array(rows[:args.limit], dtype=np.float32)
+    if len(vectors) <= args.queries:
+        sys.exit(f"Need more than {args.queries} vectors, got {len(vectors)}")
+    return vectors
+
+
+def truncate(vectors: np.ndarray, dims: int) -> np.ndarray:
+    cut = vectors[:, :dims]
+    return cut / np.linalg.norm(cut, axis=1, keepdims=True)
+
+
+def build(client: QdrantClient, name: str, vectors: np.ndarray, quantized: bool):
+    client.recreate_collection(
+        collection_name=name,
+        vectors_config=VectorParams(size=vectors.shape[1], distance=Distance.COSINE, on_disk=True if quantized else None),
+        hnsw_config=HnswConfigDiff(m=16, ef_construct=100),
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=1000),
+        quantization_config=ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+        ) if quantized else None,
+    )
+    for start in range(0, len(vectors), 1000):
+        client.upsert(name, points=[
+            PointStruct(id=start + i, vector=vec.tolist())
+            for i, vec in enumerate(vectors[start:start + 1000])
+        ])
+    while client.get_collection(name).status.value != "green":
+        time.sleep(0.5)
+
+
+def run(client: QdrantClient, name: str, queries: np.ndarray, truth: np.ndarray, k: int,
+        params: SearchParams) -> dict:
+    latencies, found = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = client.search(name, query_vector=query.tolist(), limit=k, search_params=params)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found += len({h.id for h in hits} & set(expected.tolist()))
+    return {
+        "recall": found / truth.size,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=QDRANT_URL, help="Qdrant server to build the test collections on")
+    parser.add_argument("--vectors", help=".npy file of full-size embeddings instead of the live collection")
+    parser.add_argument("--limit", type=int, default=20000, help="vectors read from the live collection")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--dims", type=int, nargs="+", default=[1536, 512, 256])
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args)
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(vectors))
+    queries, corpus = vectors[order[:args.queries]], vectors[order[args.queries:]]
+    full_corpus, full_queries = truncate(corpus, corpus.shape[1]), truncate(queries, queries.shape[1])
+    truth = np.argsort(-(full_queries @ full_corpus.T), axis=1)[:, :args.k]
+
+    client = QdrantClient(location=args.url)
+    rescore = SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=args.oversampling))
+    layouts = [(d, False) for d in args.dims] + [(d, True) for d in args.dims]
+    print(f"{len(corpus)} vectors, {len(queries)} queries, recall@{args.k} against exact full-size search\n")
+    print(f"{'layout':<22}{'RAM MiB':>10}{'disk MiB':>10}{'recall':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    for dims, quantized in layouts:
+        name = f"bench_{uuid.uuid4().hex[:8]}"
+        build(client, name, truncate(corpus, dims), quantized)
+        try:
+            result = run(client, name, truncate(queries, dims), truth, args.k, rescore if quantized else None)
+        finally:
+            client.delete_collection(name)
+        float_mib = len(corpus) * dims * 4 / 2 ** 20
+        ram = len(corpus) * dims / 2 ** 20 if quantized else float_mib
+        disk = float_mib if quantized else 0.0
+        label = f"{dims}d " + ("int8+rescore" if quantized else "float32")
+        print(f"{label:<22}{ram:>10.1f}{disk:>10.1f}{result['recall']:>9.3f}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
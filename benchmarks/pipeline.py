@@ -0,0 +1,383 @@
+"""Throughput and latency of the ingest and query hot paths.
+
+Runs entirely in-process, so results depend only on the code and the machine:
+synthetic lab reports (benchmarks.synthetic_reports), an in-memory Qdrant, and a
+deterministic hashing embedder and canned LLM in place of the API providers.
+Measures:
+
+- extraction: extract_chunks_from_pdf pages/sec on text and scanned (OCR) reports
+- ingest: upsert_chunks chunks/sec, first upload and unchanged re-upload
+- query: search_chunks, the /beta/query retrieval + prompt path and
+  VectorStore.hybrid_search, p50/p95/p99 with a cold query-embedding cache
+- prompts: the prompt builders on real retrieved hits
+- peak RSS of the benchmark process and of the extraction worker processes
+
+Results are written as JSON. Passing --baseline compares against an earlier run
+and exits with status 1 if a metric got worse by more than --tolerance.
+
+    python -m benchmarks.pipeline --output before.json
+    python -m benchmarks.pipeline --baseline before.json --output after.json
+    python -m benchmarks.pipeline --pages 1 4 --reports 10 --queries 50 --no-scanned
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+
+# The stores build their API clients at import time; nothing here calls them
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from qdrant_client import AsyncQdrantClient, QdrantClient
+
+import qdrant_store
+from benchmarks.synthetic_reports import TESTS, make_report
+from config import Config
+from embedding_cache import EmbeddingCache
+from embedding_providers import EmbeddingProvider
+from embedding_scheduler import BULK
+from extract_chunks import extract_chunks_from_pdf, shutdown_worker_pool
+from llm_prompter import build_prompt, build_prompt_beta, build_prompt_trends, format_series_table, pack_context
+from query_cache import QueryEmbeddingCache
+from structured_parser import find_mentioned_tests, parse_lab_report
+from vector_store import VectorStore
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+QUESTIONS = [
+    "What is my {test} level?",
+    "Is my {test} within the normal range?",
+    "How has my {test} changed over time?",
+    "Should I be worried about my {test} result?",
+    "What does a high {test} mean?",
+    "Which of my results are abnormal apart from {test}?",
+]
+TREND_MAX_TESTS = 12
+_WORD = re.compile(r"\w+")
+
+
+class HashEmbeddingProvider(EmbeddingProvider):
+    """Deterministic stand-in for an embedding API: hashed bag of words, so texts that
+    share words still land near each other and search results stay meaningful."""
+
+    model = "benchmark-hash"
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def _vector(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in _WORD.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+            vector[h % self.dimensions] += 1.0 if h >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    async def embed(self, texts, token_counts=None, priority=BULK):
+        return [self._vector(text) for text in texts]
+
+
+def stub_answer(messages: List[Dict]) -> str:
+    """Canned chat completion: the first context line of the prompt."""
+    lines = [line for line in messages[-1]["content"].splitlines() if line.strip()]
+    return lines[1] if len(lines) > 1 else ""
+
+
+def latency_stats(samples: List[float]) -> Dict:
+    ms = np.array(samples) * 1000
+    return {
+        "count": len(samples),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def peak_rss_mib(who=resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    return resource.getrusage(who).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def make_questions(count: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    return [rng.choice(QUESTIONS).format(test=rng.choice(TESTS)[0]) for _ in range(count)]
+
+
+def bench_extraction(args) -> Dict:
+    results = {}
+    variants = [("text", False, args.repeat)] + ([("scanned", True, 1)] if args.scanned else [])
+    for variant, scanned, repeat in variants:
+        for pages in args.pages:
+            data = make_report(pages, scanned, seed=pages)
+            try:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    chunks, _ = extract_chunks_from_pdf(data)
+                elapsed = time.perf_counter() - start
+            except Exception as e:  # e.g. no tesseract binary for the scanned variant
+                results[f"{variant}_{pages}p"] = {"pages": pages, "error": str(e)}
+                print(f"  {variant:<8}{pages:>5} pages  skipped: {e}")
+                continue
+            results[f"{variant}_{pages}p"] = {
+                "pages": pages,
+                "chunks": len(chunks),
+                "seconds": elapsed / repeat,
+                "pages_per_sec": pages * repeat / elapsed,
+            }
+            print(f"  {variant:<8}{pages:>5} pages  {pages * repeat / elapsed:>9.1f} pages/s  {len(chunks):>5} chunks")
+    return results
+
+
+def make_corpus(args) -> List[Dict]:
+    """Extracted reports spread over args.users users, as they'd arrive at ingest."""
+    corpus = []
+    for i in range(args.reports):
+        data = make_report(args.pages[i % len(args.pages)], seed=1000 + i)
+        chunks, full_text = extract_chunks_from_pdf(data)
+        corpus.append({
+            "user_id": f"user{i % args.users}",
+            "filename": f"report_{i:04d}.pdf",
+            "file_hash": hashlib.sha256(data).hexdigest(),
+            "chunks": chunks,
+            "full_text": full_text,
+        })
+    return corpus
+
+
+def use_in_memory_store(embedder: EmbeddingProvider, workdir: str):
+    """Point qdrant_store at an in-memory Qdrant, the stub embedder and an empty cache."""
+    qdrant_store.client = AsyncQdrantClient(location=":memory:")
+    qdrant_store.embedding_provider = embedder
+    qdrant_store.EMBED_MODEL = embedder.model
+    qdrant_store.EMBED_DIM = embedder.dimensions
+    qdrant_store.embedding_cache = EmbeddingCache(os.path.join(workdir, "embedding_cache.sqlite3"))
+    # ttl=0: every query is embedded, so latencies are cold-cache
+    qdrant_store.query_embedding_cache = QueryEmbeddingCache(ttl=0)
+    qdrant_store._collection_ready = False
+
+
+async def bench_ingest(corpus: List[Dict]) -> Dict:
+    await qdrant_store.init_collection()
+    results = {}
+    for label in ("first_upload", "unchanged_reupload"):
+        chunk_count = 0
+        start = time.perf_counter()
+        for report in corpus:
+            await qdrant_store.upsert_chunks(report["user_id"], report["filename"], report["chunks"], report["user_id"])
+            chunk_count += len(report["chunks"])
+        elapsed = time.perf_counter() - start
+        results[label] = {"chunks": chunk_count, "seconds": elapsed, "chunks_per_sec": chunk_count / elapsed}
+        print(f"  {label:<20}{chunk_count / elapsed:>9.1f} chunks/s  ({chunk_count} chunks)")
+    return results
+
+
+async def bench_search(questions: List[str], users: int) -> Dict:
+    search, pipeline = [], []
+    for i, question in enumerate(questions):
+        user_id = f"user{i % users}"
+        start = time.perf_counter()
+        await qdrant_store.search_chunks(question, top_k=5, user_id=user_id)
+        search.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hits, _ = pack_context(await qdrant_store.search_chunk_hits(question, top_k=15, user_id=user_id))
+        if hits:
+            prompt = build_prompt_beta(question, qdrant_store.group_by_report(hits))
+            stub_answer([{"role": "user", "content": prompt}])
+        pipeline.append(time.perf_counter() - start)
+    results = {"search_chunks": latency_stats(search), "beta_query_pipeline": latency_stats(pipeline)}
+    for name, stats in results.items():
+        print(f"  {name:<20}p50 {stats['p50_ms']:>7.2f} ms  p95 {stats['p95_ms']:>7.2f} ms  p99 {stats['p99_ms']:>7.2f} ms")
+    return results
+
+
+async def bench_hybrid_search(corpus: List[Dict], questions: List[str], args, embedder, workdir: str) -> Dict:
+    config = Config()
+    config.collection_name = "benchmark_hybrid"
+    config.hybrid_mode = args.hybrid_mode
+    config.keyword_index_dir = os.path.join(workdir, "bm25")
+    config.embedding_cache_path = os.path.join(workdir, "vector_store_cache.sqlite3")
+    store = VectorStore(config, client=QdrantClient(location=":memory:"), embedder=embedder)
+    store.query_cache = QueryEmbeddingCache(ttl=0)
+    for report in corpus:
+        await store.add_documents([
+            {"content": chunk, "metadata": {"file_hash": report["file_hash"], "filename": report["filename"],
+                                            "user_id": report["user_id"]}}
+            for chunk in report["chunks"]
+        ])
+    samples = []
+    for i, question in enumerate(questions):
+        start = time.perf_counter()
+        await store.hybrid_search(question, {"user_id": f"user{i % args.users}"}, top_k=5)
+        samples.append(time.perf_counter() - start)
+    stats = latency_stats(samples)
+    print(f"  {'hybrid_search':<20}p50 {stats['p50_ms']:>7.2f} ms  p95 {stats['p95_ms']:>7.2f} ms  p99 {stats['p99_ms']:>7.2f} ms"
+          f"  ({store.hybrid_mode})")
+    return {f"hybrid_search_{store.hybrid_mode}": stats}
+
+
+async def bench_prompts(corpus: List[Dict], questions: List[str], args) -> Dict:
+    # Inputs are prepared up front so only the builders are timed
+    series_by_user = {}
+    for report in corpus:
+        series = series_by_user.setdefault(report["user_id"], {})
+        for row in parse_lab_report(report["full_text"]):
+            series.setdefault(row["test_key"], []).append({**row, "filename": report["filename"]})
+    cases = []
+    for i, question in enumerate(questions):
+        user_id = f"user{i % args.users}"
+        hits = await qdrant_store.search_chunk_hits(question, top_k=15, user_id=user_id)
+        series = series_by_user.get(user_id, {})
+        mentioned = find_mentioned_tests(question, list(series))[:TREND_MAX_TESTS]
+        trend = {key: sorted(series[key], key=lambda row: row["report_date"] or datetime.min) for key in mentioned}
+        cases.append((question, hits, trend))
+
+    def run(build) -> Dict:
+        samples = []
+        for _ in range(args.repeat):
+            for case in cases:
+                start = time.perf_counter()
+                build(*case)
+                samples.append(time.perf_counter() - start)
+        return latency_stats(samples)
+
+    results = {
+        "build_prompt": run(lambda q, hits, _: build_prompt(q, [hit["text"] for hit in hits[:5]])),
+        "pack_context_beta": run(lambda q, hits, _: build_prompt_beta(q, qdrant_store.group_by_report(pack_context(hits)[0]))),
+        "build_prompt_trends": run(lambda q, _, trend: build_prompt_trends(q, format_series_table(trend))),
+    }
+    for name, stats in results.items():
+        print(f"  {name:<20}p50 {stats['p50_ms']:>7.3f} ms  p95 {stats['p95_ms']:>7.3f} ms  p99 {stats['p99_ms']:>7.3f} ms")
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)."""
+    regressions = []
+    before = flatten({k: v for k, v in baseline.items() if k != "meta"})
+    after = flatten({k: v for k, v in current.items() if k != "meta"})
+    for name, old in before.items():
+        new = after.get(name)
+        if new is None or not old:
+            continue
+        if name.endswith("_per_sec"):
+            change = (old - new) / old
+        elif name.endswith(("_ms", "_mib")):
+            change = (new - old) / old
+        else:
+            continue
+        if change > tolerance:
+            regressions.append(f"{name}: {old:.3f} -> {new:.3f} ({change:+.0%} worse)")
+    return regressions
+
+
+async def run_benchmarks(args) -> Dict:
+    embedder = HashEmbeddingProvider(args.dims)
+    results = {"meta": {
+        "timestamp": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }}
+    memory = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        print("Extraction")
+        results["extraction"] = bench_extraction(args)
+        memory["after_extraction_mib"] = peak_rss_mib()
+
+        corpus = make_corpus(args)
+        questions = make_questions(args.queries, args.seed)
+        use_in_memory_store(embedder, workdir)
+
+        print("Ingest")
+        results["ingest"] = await bench_ingest(corpus)
+        memory["after_ingest_mib"] = peak_rss_mib()
+
+        print("Query")
+        results["query"] = await bench_search(questions, args.users)
+        results["query"].update(await bench_hybrid_search(corpus, questions, args, embedder, workdir))
+        memory["after_query_mib"] = peak_rss_mib()
+
+        print("Prompts")
+        results["prompts"] = await bench_prompts(corpus, questions, args)
+
+    # Peak RSS is a high-water mark, so each stage's figure includes the stages before it
+    memory["peak_mib"] = peak_rss_mib()
+    # Children only count once they have exited and been waited for
+    shutdown_worker_pool()
+    memory["workers_peak_mib"] = peak_rss_mib(resource.RUSAGE_CHILDREN)
+    results["memory"] = memory
+    print(f"Peak RSS: {memory['peak_mib']:.1f} MiB (extraction workers: {memory['workers_peak_mib']:.1f} MiB)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 8, 40],
+                        help="page counts of the extraction reports, cycled through for the ingest corpus")
+    parser.add_argument("--no-scanned", dest="scanned", action="store_false", help="skip the OCR variant")
+    parser.add_argument("--reports", type=int, default=40, help="reports in the ingest corpus")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per text extraction and per prompt case")
+    parser.add_argument("--dims", type=int, default=256, help="stub embedding size")
+    parser.add_argument("--hybrid-mode", default="sparse", choices=["sparse", "local"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a metric counts as regressed")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Synthetic lab-report PDFs for the benchmarks.
+
+Reports are laid out like the lab PDFs users upload: a header with patient details
+and a report date, then "Test Report" panels of result rows (name, value, flag,
+unit, reference range). The same seed always produces the same report. The
+scanned variant rasterizes every page into an image with no text layer, so
+extraction has to go through OCR.
+
+    python -m benchmarks.synthetic_reports --pages 12 --scanned --out report.pdf
+"""
+import argparse
+import random
+from datetime import date, timedelta
+from typing import List, Tuple
+
+import fitz
+
+# name, unit, low, high
+TESTS = [
+    ("Hemoglobin", "g/dL", 12.0, 16.0),
+    ("Hematocrit (PCV)", "%", 36.0, 46.0),
+    ("RBC Count", "mill/cmm", 4.5, 5.5),
+    ("WBC Count", "cells/cmm", 4000, 11000),
+    ("Platelet Count", "10^3/uL", 150, 450),
+    ("MCV", "fL", 80.0, 100.0),
+    ("MCH", "pg", 27.0, 32.0),
+    ("MCHC", "g/dL", 32.0, 36.0),
+    ("Neutrophils", "%", 40.0, 80.0),
+    ("Lymphocytes", "%", 20.0, 40.0),
+    ("Glucose Fasting", "mg/dL", 70, 100),
+    ("HbA1c", "%", 4.0, 5.6),
+    ("Total Cholesterol", "mg/dL", 125, 200),
+    ("HDL Cholesterol", "mg/dL", 40, 60),
+    ("LDL Cholesterol", "mg/dL", 50, 130),
+    ("Triglycerides", "mg/dL", 50, 150),
+    ("Creatinine", "mg/dL", 0.6, 1.2),
+    ("Blood Urea Nitrogen", "mg/dL", 7, 20),
+    ("Uric Acid", "mg/dL", 3.5, 7.2),
+    ("Sodium", "mmol/L", 135, 145),
+    ("Potassium", "mmol/L", 3.5, 5.1),
+    ("SGOT (AST)", "U/L", 5, 40),
+    ("SGPT (ALT)", "U/L", 7, 56),
+    ("Alkaline Phosphatase", "U/L", 44, 147),
+    ("Total Bilirubin", "mg/dL", 0.1, 1.2),
+    ("TSH", "uIU/mL", 0.4, 4.0),
+    ("Free T4", "ng/dL", 0.8, 1.8),
+    ("Vitamin D (25-OH)", "ng/mL", 30, 100),
+    ("Vitamin B12", "pg/mL", 200, 900),
+    ("Ferritin", "ng/mL", 12, 300),
+]
+PANELS = ["Complete Blood Count", "Lipid Profile", "Kidney Function Test", "Liver Function Test",
+          "Thyroid Profile", "Diabetes Panel", "Electrolytes", "Vitamin Profile"]
+ROWS_PER_PAGE = 24
+PAGE_WIDTH, PAGE_HEIGHT = fitz.paper_size("a4")
+
+
+def _fmt(value: float, like) -> str:
+    """Format with the precision of the test's reference range."""
+    return f"{value:.1f}" if isinstance(like, float) else f"{value:.0f}"
+
+
+def _result_row(rng: random.Random) -> Tuple[str, str, str, str, str]:
+    name, unit, low, high = rng.choice(TESTS)
+    span = high - low
+    value = rng.uniform(low - 0.3 * span, high + 0.3 * span)
+    flag = "H" if value > high else "L" if value < low else ""
+    return name, _fmt(value, low), flag, unit, f"{_fmt(low, low)} - {_fmt(high, low)}"
+
+
+def _write_page(page, rng: random.Random, page_number: int, page_count: int, patient: str, report_date: date):
+    y = 50
+    page.insert_text((50, y), "City Diagnostics Laboratory", fontsize=14)
+    y += 22
+    page.insert_text((50, y), f"Patient Name: {patient}", fontsize=10)
+    page.insert_text((330, y), f"Report Date: {report_date:%d/%m/%Y}", fontsize=10)
+    y += 30
+    for row in range(ROWS_PER_PAGE):
+        if row % 8 == 0:
+            y += 10
+            page.insert_text((50, y), f"Test Report - {rng.choice(PANELS)}", fontsize=12)
+            y += 18
+            for x, header in zip((50, 250, 300, 380), ("Test Name", "Result", "Unit", "Reference Range")):
+                page.insert_text((x, y), header, fontsize=9)
+            y += 16
+        name, value, flag, unit, ref_range = _result_row(rng)
+        for x, text in zip((50, 250, 280, 300, 380), (name, value, flag, unit, ref_range)):
+            if text:
+                page.insert_text((x, y), text, fontsize=10)
+        y += 16
+    page.insert_text((50, PAGE_HEIGHT - 40), f"Page {page_number} of {page_count}", fontsize=8)
+
+
+def make_report(pages: int, scanned: bool = False, seed: int = 0, dpi: int = 150) -> bytes:
+    """PDF bytes of a `pages`-page lab report."""
+    rng = random.Random(seed)
+    patient = f"{rng.choice(['Asha', 'Ravi', 'Meera', 'Arjun', 'Lena', 'Omar'])} {rng.choice(['Rao', 'Iyer', 'Khan', 'Shah', 'Patel'])}"
+    report_date = date(2023, 1, 1) + timedelta(days=rng.randrange(900))
+    doc = fitz.open()
+    for n in range(pages):
+        _write_page(doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT), rng, n + 1, pages, patient, report_date)
+    if scanned:
+        doc = _rasterize(doc, dpi)
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def _rasterize(doc, dpi: int):
+    scanned = fitz.open()
+    for page in doc:
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        scanned.new_page(width=page.rect.width, height=page.rect.height).insert_image(page.rect, pixmap=pix)
+    doc.close()
+    return scanned
+
+
+def make_reports(page_counts: List[int], scanned: bool = False, seed: int = 0) -> List[bytes]:
+    return [make_report(pages, scanned, seed + i) for i, pages in enumerate(page_counts)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--scanned", action="store_true", help="image-only pages, extracted by OCR")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="synthetic_report.pdf")
+    args = parser.parse_args()
+    with open(args.out, "wb") as f:
+        f.write(make_report(args.pages, args.scanned, args.seed))
+    print(f"Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import base64
+import math
+import os
+import pickle
+import re
+import threading
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def to_sparse(weights: Dict[str, float]) -> Tuple[List[int], List[float]]:
+    """Map term weights onto sparse vector (indices, values) using a stable 32-bit term hash."""
+    merged: Dict[int, float] = {}
+    for term, weight in weights.items():
+        index = zlib.crc32(term.encode())
+        merged[index] = merged.get(index, 0.0) + weight
+    return list(merged), list(merged.values())
+
+
+class _Partition:
+    """BM25 postings for one tenant.
+
+    Documents get dense internal numbers; each term's postings are two parallel
+    uint32 arrays (doc numbers, term frequencies). Removing a document only flags it
+    dead, and the postings are compacted once dead documents pile up.
+    """
+
+    def __init__(self, text_field: str):
+        self.text_field = text_field
+        self.point_ids: List[str] = []
+        self.doc_numbers: Dict[str, int] = {}
+        self.doc_len = array("I")
+        self.alive = bytearray()
+        self.payloads: Dict[int, dict] = {}
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.doc_freq: Dict[str, int] = {}
+        self.total_len = 0
+        self.live_docs = 0
+
+    def add(self, point_id: str, payload: dict):
+        if point_id in self.doc_numbers:
+            self.remove(point_id)
+        tokens = tokenize(payload.get(self.text_field, ""))
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+
+        docno = len(self.point_ids)
+        self.point_ids.append(point_id)
+        self.doc_numbers[point_id] = docno
+        self.doc_len.append(len(tokens))
+        self.alive.append(1)
+        self.payloads[docno] = payload
+        self.total_len += len(tokens)
+        self.live_docs += 1
+        for term, tf in counts.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array("I"), array("I"))
+            postings[0].append(docno)
+            postings[1].append(tf)
+            self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+
+    def remove(self, point_id: str) -> bool:
+        docno = self.doc_numbers.pop(point_id, None)
+        if docno is None:
+            return False
+        self.alive[docno] = 0
+        self.total_len -= self.doc_len[docno]
+        self.live_docs -= 1
+        payload = self.payloads.pop(docno)
+        for term in set(tokenize(payload.get(self.text_field, ""))):
+            remaining = self.doc_freq.get(term, 0) - 1
+            if remaining > 0:
+                self.doc_freq[term] = remaining
+            else:
+                self.doc_freq.pop(term, None)
+        if len(self.point_ids) - self.live_docs > max(64, self.live_docs):
+            self._compact()
+        return True
+
+    def _compact(self):
+        live = [(point_id, self.payloads[docno]) for point_id, docno in self.doc_numbers.items()]
+        self.__init__(self.text_field)
+        for point_id, payload in live:
+            self.add(point_id, payload)
+
+    def idf(self, term: str) -> float:
+        df = self.doc_freq.get(term, 0)
+        return math.log(1 + (self.live_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, terms: Iterable[str], k1: float, b: float) -> np.ndarray:
+        scores = np.zeros(len(self.point_ids), dtype=np.float32)
+        if not self.live_docs:
+            return scores
+        doc_len = np.frombuffer(self.doc_len, dtype=np.uint32)
+        avgdl = self.total_len / self.live_docs or 1.0
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            docs = np.frombuffer(postings[0], dtype=np.uint32)
+            tf = np.frombuffer(postings[1], dtype=np.uint32).astype(np.float32)
+            norm = k1 * (1 - b + b * doc_len[docs] / avgdl)
+            scores[docs] += self.idf(term) * tf * (k1 + 1) / (tf + norm)
+        scores *= np.frombuffer(self.alive, dtype=np.uint8)
+        return scores
+
+
+class BM25Index:
+    """Incremental BM25 keyword index partitioned by tenant.
+
+    Each partition is persisted to its own file under `path`, so an update only
+    rewrites the affected tenant and restarts load the index instead of rebuilding it.
+    Payloads are kept alongside the postings, so hits need no vector store lookup.
+    """
+
+    def __init__(self, path: str, text_field: str = "content", k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.text_field = text_field
+        self.k1 = k1
+        self.b = b
+        self._partitions: Dict[str, _Partition] = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, partition: str) -> str:
+        return os.path.join(self.path, base64.urlsafe_b64encode(partition.encode()).decode() + ".bm25")
+
+    def _load(self, partition: str, create: bool = False) -> Optional[_Partition]:
+        part = self._partitions.get(partition)
+        if part is None:
+            file = self._file(partition)
+            if os.path.exists(file):
+                with open(file, "rb") as f:
+                    part = pickle.load(f)
+            elif create:
+                part = _Partition(self.text_field)
+            else:
+                return None
+            self._partitions[partition] = part
+        return part
+
+    def _save(self, partition: str):
+        file = self._file(partition)
+        tmp = file + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self._partitions[partition], f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, file)
+
+    def partitions(self) -> List[str]:
+        names = set(self._partitions)
+        for entry in os.listdir(self.path):
+            if entry.endswith(".bm25"):
+                names.add(base64.urlsafe_b64decode(entry[:-len(".bm25")]).decode())
+        return sorted(names)
+
+    def is_empty(self) -> bool:
+        return not self._partitions and not any(e.endswith(".bm25") for e in os.listdir(self.path))
+
+    def add(self, partition: str, documents: List[Tuple[str, dict]]):
+        """Index (point_id, payload) pairs in one partition; the text is payload[text_field]."""
+        with self._lock:
+            part = self._load(partition, create=True)
+            for point_id, payload in documents:
+                part.add(point_id, payload)
+            self._save(partition)
+
+    def remove(self, partition: str, point_ids: List[str]):
+        with self._lock:
+            part = self._load(partition)
+            if part is None:
+                return
+            if any([part.remove(point_id) for point_id in point_ids]):
+                self._save(partition)
+
+    def document_weights(self, partition: str, text: str) -> Dict[str, float]:
+        """Document side of BM25 (saturated, length-normalized term frequency) for `text`.
+
+        Stored as a sparse vector, its dot product with query_weights() is the BM25 score.
+        """
+        tokens = tokenize(text)
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        with self._lock:
+            part = self._load(partition)
+            avgdl = part.total_len / part.live_docs if part is not None and part.live_docs else len(tokens)
+        norm = self.k1 * (1 - self.b + self.b * len(tokens) / (avgdl or 1))
+        return {term: tf * (self.k1 + 1) / (tf + norm) for term, tf in counts.items()}
+
+    def query_weights(self, partition: Optional[str], query: str) -> Dict[str, float]:
+        """Query side of BM25: the IDF of each query term within the partition (or all partitions)."""
+        terms = set(tokenize(query))
+        names = [partition] if partition is not None else self.partitions()
+        docs = 0
+        doc_freq = dict.fromkeys(terms, 0)
+        with self._lock:
+            for name in names:
+                part = self._load(name)
+                if part is None:
+                    continue
+                docs += part.live_docs
+                for term in terms:
+                    doc_freq[term] += part.doc_freq.get(term, 0)
+        return {
+            term: math.log(1 + (docs - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+            if df
+        }
+
+    def search(self, query: str, partition: Optional[str], limit: int,
+               payload_filter: Optional[Dict] = None) -> List[Dict]:
+        """Top BM25 hits as {"id", "score", "payload"}. With partition=None all partitions are searched."""
+        terms = tokenize(query)
+        names = [partition] if partition is not None else self.partitions()
+        results = []
+        with self._lock:
+            for name in names:
+                part = self._load(name)
+                if part is None:
+                    continue
+                scores = part.search(terms, self.k1, self.b)
+                candidates = np.nonzero(scores > 0)[0]
+                found = 0
+                for docno in candidates[np.argsort(scores[candidates])[::-1]]:
+                    payload = part.payloads[int(docno)]
+                    if payload_filter and any(payload.get(k) != v for k, v in payload_filter.items()):
+                        continue
+                    results.append({
+                        "id": part.point_ids[docno],
+                        "score": float(scores[docno]),
+                        "payload": payload
+                    })
+                    found += 1
+                    if found >= limit:
+                        break
+        results.sort(key=lambda r: r["score"], reverse=True)
+        return results[:limit]
@@ -1,12 +1,251 @@
-from collections import defaultdict
+import asyncio
+import logging
+import os
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List
 
-user_memory = defaultdict(list)
+import tiktoken
+from pymongo.errors import OperationFailure
 
-def get_user_history(user_id: str):
-    return user_memory[user_id]
+CHAT_MEMORY_BACKEND = os.getenv("CHAT_MEMORY_BACKEND", "memory")  # "memory" or "mongo"
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "2000"))  # history budget per prompt
+CHAT_MEMORY_MAX_MESSAGES = int(os.getenv("CHAT_MEMORY_MAX_MESSAGES", "50"))  # stored per user
+CHAT_MEMORY_IDLE_TTL = int(os.getenv("CHAT_MEMORY_IDLE_TTL", "86400"))  # seconds before an idle user is evicted
+CHAT_MEMORY_SUMMARIZE = os.getenv("CHAT_MEMORY_SUMMARIZE", "0") == "1"
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "300"))
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
+# Budget of the verbatim turns; with summaries on, the summary's share is set aside so the
+# turns that are folded and the turns that are sent always meet
+CHAT_TURNS_TOKENS = max(0, CHAT_HISTORY_TOKENS - CHAT_SUMMARY_TOKENS) if CHAT_MEMORY_SUMMARIZE else CHAT_HISTORY_TOKENS
 
-def add_to_history(user_id: str, role: str, content: str):
-    user_memory[user_id].append({"role": role, "content": content})
+try:
+    _encoding = tiktoken.encoding_for_model(CHAT_MODEL)
+except KeyError:
+    _encoding = tiktoken.get_encoding("cl100k_base")
 
-def clear_user_history(user_id: str):
-    user_memory[user_id] = []
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _message(role: str, content: str) -> Dict:
+    # Token counts are stored with each message so trimming never re-tokenizes history;
+    # the id marks how far a summary reaches when the list has shifted meanwhile
+    return {"id": uuid.uuid4().hex, "role": role, "content": content, "tokens": count_tokens(content) + 4}
+
+
+class InMemoryChatStore:
+    """Per-process history; users idle for longer than idle_ttl are dropped."""
+
+    def __init__(self, max_messages: int = CHAT_MEMORY_MAX_MESSAGES, idle_ttl: int = CHAT_MEMORY_IDLE_TTL):
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self._users: "OrderedDict[str, Dict]" = OrderedDict()  # least recently active first
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if state["last_active"] >= cutoff:
+                break
+            del self._users[user_id]
+
+    def _touch(self, user_id: str) -> Dict:
+        self._evict_idle()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = {"messages": [], "summary": ""}
+        state["last_active"] = time.monotonic()
+        self._users.move_to_end(user_id)
+        return state
+
+    async def load(self, user_id: str) -> Dict:
+        self._evict_idle()
+        state = self._users.get(user_id)
+        if state is None:
+            return {"messages": [], "summary": ""}
+        return {"messages": list(state["messages"]), "summary": state["summary"]}
+
+    async def append(self, user_id: str, messages: List[Dict]):
+        state = self._touch(user_id)
+        state["messages"].extend(messages)
+        del state["messages"][:-self.max_messages]
+
+    async def compact(self, user_id: str, last_summarized: str, summary: str):
+        state = self._users.get(user_id)
+        if state is not None:
+            messages = state["messages"]
+            # If append() already trimmed it away, so were the turns before it
+            position = next((i for i, m in enumerate(messages) if m.get("id") == last_summarized), -1)
+            del messages[:position + 1]
+            state["summary"] = summary
+
+    async def clear(self, user_id: str):
+        self._users.pop(user_id, None)
+
+
+class MongoChatStore:
+    """History in the `chat_history` collection, shared by every API worker.
+
+    One document per user; idle users are removed by a TTL index on updated_at.
+    """
+
+    def __init__(self, max_messages: int = CHAT_MEMORY_MAX_MESSAGES, idle_ttl: int = CHAT_MEMORY_IDLE_TTL):
+        from database import mongo_db
+        self.collection = mongo_db.chat_history
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self._indexed = False
+
+    async def _ensure_index(self):
+        if not self._indexed:
+            try:
+                await self.collection.create_index("updated_at", expireAfterSeconds=self.idle_ttl)
+            except OperationFailure:
+                # The index exists with another TTL (CHAT_MEMORY_IDLE_TTL changed): update it in place
+                try:
+                    await self.collection.database.command({
+                        "collMod": self.collection.name,
+                        "index": {"keyPattern": {"updated_at": 1}, "expireAfterSeconds": self.idle_ttl},
+                    })
+                except OperationFailure as e:
+                    logger.warning(f"Could not update the chat_history TTL index: {e}")
+            self._indexed = True
+
+    async def load(self, user_id: str) -> Dict:
+        doc = await self.collection.find_one({"_id": user_id}, {"messages": 1, "summary": 1})
+        if doc is None:
+            return {"messages": [], "summary": ""}
+        return {"messages": doc.get("messages", []), "summary": doc.get("summary", "")}
+
+    async def append(self, user_id: str, messages: List[Dict]):
+        await self._ensure_index()
+        await self.collection.update_one(
+            {"_id": user_id},
+            {
+                "$push": {"messages": {"$each": messages, "$slice": -self.max_messages}},
+                "$set": {"updated_at": datetime.utcnow()},
+                "$setOnInsert": {"summary": ""},
+            },
+            upsert=True,
+        )
+
+    async def compact(self, user_id: str, last_summarized: str, summary: str):
+        # Pipeline update relative to the last summarized turn, so turns appended or trimmed
+        # by another worker meanwhile are neither lost nor kept twice
+        position = {"$indexOfArray": [{"$map": {"input": "$messages", "in": "$$this.id"}}, last_summarized]}
+        await self.collection.update_one(
+            {"_id": user_id},
+            [{"$set": {
+                "summary": summary,
+                "messages": {"$slice": ["$messages", {"$add": [position, 1]}, self.max_messages]},
+            }}],
+        )
+
+    async def clear(self, user_id: str):
+        await self.collection.delete_one({"_id": user_id})
+
+
+def trim_to_budget(messages: List[Dict], budget: int) -> List[Dict]:
+    """Most recent messages whose stored token counts fit in `budget`."""
+    kept = 0
+    used = 0
+    for message in reversed(messages):
+        used += message["tokens"]
+        if used > budget:
+            break
+        kept += 1
+    return messages[len(messages) - kept:]
+
+
+_summary_client = None
+_summarizing = set()  # user ids with a summarization in flight
+
+
+async def _summarize(summary: str, messages: List[Dict]) -> str:
+    from openai import AsyncOpenAI
+
+    global _summary_client
+    if _summary_client is None:
+        _summary_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = (
+        "Update the summary of this conversation between a patient and a medical report assistant. "
+        "Keep the facts, values and questions that later questions may refer to.\n\n"
+        f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"
+    )
+    resp = await _summary_client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.0,
+        max_tokens=CHAT_SUMMARY_TOKENS,
+    )
+    return resp.choices[0].message.content
+
+
+async def _fold_old_turns(user_id: str):
+    try:
+        state = await store.load(user_id)
+        messages = state["messages"]
+        kept = trim_to_budget(messages, CHAT_TURNS_TOKENS)
+        dropped = len(messages) - len(kept)
+        # History from before messages had ids is left as it is until it ages out
+        if dropped and messages[dropped - 1].get("id"):
+            summary = await _summarize(state["summary"], messages[:dropped])
+            await store.compact(user_id, messages[dropped - 1]["id"], summary)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        _summarizing.discard(user_id)
+
+
+def _create_store():
+    if CHAT_MEMORY_BACKEND == "mongo":
+        return MongoChatStore()
+    return InMemoryChatStore()
+
+
+store = _create_store()
+_background = set()
+
+
+async def get_user_history(user_id: str) -> List[Dict]:
+    """Chat messages to prepend to a prompt, trimmed to CHAT_HISTORY_TOKENS.
+
+    Turns that no longer fit are dropped, or with CHAT_MEMORY_SUMMARIZE=1 folded into a
+    running summary that is sent as a system message ahead of the recent turns.
+    """
+    state = await store.load(user_id)
+    history = []
+    if state["summary"]:
+        history.append({"role": "system", "content": "Summary of the earlier conversation: " + state["summary"]})
+    history.extend(
+        {"role": m["role"], "content": m["content"]}
+        for m in trim_to_budget(state["messages"], CHAT_TURNS_TOKENS)
+    )
+    return history
+
+
+async def add_exchange(user_id: str, question: str, answer: str):
+    """Record one question/answer turn. Store the user's question, not the RAG prompt."""
+    await store.append(user_id, [_message("user", question), _message("assistant", answer)])
+    if CHAT_MEMORY_SUMMARIZE and user_id not in _summarizing:
+        # Summarize off the request path; the next query just sees the trimmed history until then
+        _summarizing.add(user_id)
+        task = asyncio.create_task(_fold_old_turns(user_id))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+async def add_to_history(user_id: str, role: str, content: str):
+    await store.append(user_id, [_message(role, content)])
+
+
+async def clear_user_history(user_id: str):
+    await store.clear(user_id)
@@ -27,22 +27,31 @@ class Config:
         self.embedding_provider = os.getenv("EMBEDDING_PROVIDER", "openai")
         self.openai_embedding_model = "text-embedding-ada-002"
         self.embedding_dimensions = 1536  # For OpenAI ada-002
+        self.embedding_cache_path = os.getenv("EMBED_CACHE_PATH", "storage/embedding_cache.sqlite3")
+        self.embedding_cache_max_entries = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "200000"))
         
         # RAG settings
-        self.chunk_size = 256
-        self.chunk_overlap = 100
+        self.chunk_size = int(os.getenv("CHUNK_SIZE", "256"))  # tokens
+        self.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "100"))
         self.k_retrieval = 5
         
+        # Keyword index
+        self.keyword_index_dir = os.getenv("KEYWORD_INDEX_DIR", "storage/bm25")
+        self.keyword_partition_key = "user_id"
+        self.hybrid_mode = os.getenv("HYBRID_MODE", "sparse")  # "sparse" (in Qdrant) or "local"
+        
         # Search weights
         self.vector_weight = 0.7
         self.keyword_weight = 0.3
+        self.fusion_method = os.getenv("HYBRID_FUSION", "rrf")  # "rrf" or "weighted"
+        self.rrf_k = 60
         
         # File settings
         self.upload_dir = "data/uploads"
         self.max_file_size_mb = 50
         
         # Performance
-        self.cache_ttl = 3600
+        self.cache_ttl = int(os.getenv("CACHE_TTL", "3600"))
         
     @property
     def max_file_size_bytes(self):
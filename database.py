@@ -1,10 +1,17 @@
 from dotenv import load_dotenv
 from fastapi import FastAPI, UploadFile, Form, HTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
 from passlib.context import CryptContext
 from jose import jwt
 from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import logging
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import Depends, Header
 
 load_dotenv()
@@ -12,29 +19,69 @@ load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI")
 client = AsyncIOMotorClient(MONGO_URI)
 mongo_db = client["rag"]
+logger = logging.getLogger(__name__)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+async def ensure_indexes():
+    """Indexes behind the per-request user lookups; created once at startup."""
+    try:
+        await mongo_db.users.create_index("username", unique=True)
+    except OperationFailure as e:
+        # Existing duplicate usernames block the unique index; lookups still work without it
+        logger.warning(f"Could not create unique index on users.username: {e}")
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # log2 work factor of new hashes
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", "2"))  # threads for bcrypt
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))  # seconds a verified token is trusted without decoding
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 SECRET_KEY = os.getenv("JWT_SECRET", "secret123")
 ALGORITHM = "HS256"
 
+# bcrypt is deliberately slow; it runs here so a burst of logins queues on these threads
+# instead of stalling the event loop (or taking over the default executor)
+_auth_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+
+# sha256(token) -> (user id, unix time until which the token is trusted), least recently used first
+_verified_tokens: "OrderedDict[bytes, tuple]" = OrderedDict()
+
 def hash_password(password):
     return pwd_context.hash(password)
 
 def verify_password(password, hashed):
     return pwd_context.verify(password, hashed)
 
+async def hash_password_async(password):
+    return await asyncio.get_running_loop().run_in_executor(_auth_pool, hash_password, password)
+
+async def verify_password_async(password, hashed):
+    return await asyncio.get_running_loop().run_in_executor(_auth_pool, verify_password, password, hashed)
+
 def create_token(data: dict, expires_delta=timedelta(days=1)):
     to_encode = data.copy()
     expire = datetime.utcnow() + expires_delta
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_user_id_from_token(authorization: str = Header(...)) -> str:
+async def get_user_id_from_token(authorization: str = Header(...)) -> str:
     if not authorization.startswith("Bearer "):
         raise HTTPException(401, "Invalid authorization header")
     token = authorization.split(" ")[1]
+    key = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    cached = _verified_tokens.get(key)
+    if cached is not None:
+        if now < cached[1]:
+            _verified_tokens.move_to_end(key)
+            return cached[0]
+        del _verified_tokens[key]
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return payload.get("sub")
     except Exception:
         raise HTTPException(401, "Invalid or expired token")
+    # Never trust a cached token past its own expiry
+    valid_until = min(now + TOKEN_CACHE_TTL, payload.get("exp", now + TOKEN_CACHE_TTL))
+    _verified_tokens[key] = (payload.get("sub"), valid_until)
+    while len(_verified_tokens) > TOKEN_CACHE_MAX_ENTRIES:
+        _verified_tokens.popitem(last=False)
+    return payload.get("sub")
@@ -0,0 +1,212 @@
+import asyncio
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+from embedding_scheduler import BULK, INTERACTIVE, EmbeddingScheduler
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+LOCAL_EMBED_BATCH_SIZE = int(os.getenv("LOCAL_EMBED_BATCH_SIZE", "32"))  # texts per forward pass
+LOCAL_EMBED_MAX_WAIT_MS = float(os.getenv("LOCAL_EMBED_MAX_WAIT_MS", "2"))  # wait for a batch to fill up
+LOCAL_EMBED_WORKERS = int(os.getenv("LOCAL_EMBED_WORKERS", "1"))  # inference threads
+LOCAL_EMBED_THREADS = int(os.getenv("LOCAL_EMBED_THREADS", "0"))  # intra-op threads per pass, 0 = library default
+LOCAL_EMBED_BACKEND = os.getenv("LOCAL_EMBED_BACKEND", "torch")  # "torch" or "onnx"
+
+OPENAI_NATIVE_DIMS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+
+
+class EmbeddingProvider:
+    """What the stores need from an embedding backend.
+
+    `model` and `dimensions` key the embedding caches and size the collection; embed()
+    takes optional token counts (for providers that rate-limit on tokens) and a priority,
+    INTERACTIVE for query embeddings or BULK for ingest.
+    """
+
+    model: str
+    dimensions: int
+
+    async def embed(self, texts: List[str], token_counts: Optional[List[int]] = None,
+                    priority: int = BULK) -> List[List[float]]:
+        raise NotImplementedError
+
+    async def embed_one(self, text: str, priority: int = INTERACTIVE) -> List[float]:
+        return (await self.embed([text], priority=priority))[0]
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAI embeddings through the shared rate-limited scheduler."""
+
+    def __init__(self, model: Optional[str] = None, dimensions: Optional[int] = None, **scheduler_options):
+        self.model = model or "text-embedding-3-small"
+        native = OPENAI_NATIVE_DIMS.get(self.model, 1536)
+        self.dimensions = dimensions or native
+        self.scheduler = EmbeddingScheduler(
+            self.model,
+            dimensions=self.dimensions if self.dimensions != native else None,
+            **scheduler_options,
+        )
+
+    async def embed(self, texts, token_counts=None, priority=BULK):
+        return await self.scheduler.embed(texts, token_counts, priority)
+
+    async def embed_one(self, text, priority=INTERACTIVE):
+        return await self.scheduler.embed_one(text, priority=priority)
+
+    async def aclose(self):
+        await self.scheduler.aclose()
+
+
+class GeminiEmbeddingProvider(EmbeddingProvider):
+    def __init__(self, model: Optional[str] = None, dimensions: Optional[int] = None, api_key: str = GEMINI_API_KEY):
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self.model = model if model and model.startswith(("models/", "tunedModels/")) else "models/embedding-001"
+        if dimensions and dimensions != 768:
+            raise ValueError(f"{self.model} produces 768-dim vectors, configured for {dimensions}")
+        self.dimensions = 768
+
+    async def embed(self, texts, token_counts=None, priority=BULK):
+        if not texts:
+            return []
+        task_type = "retrieval_query" if priority == INTERACTIVE else "retrieval_document"
+        result = await asyncio.to_thread(self._genai.embed_content, model=self.model, content=texts, task_type=task_type)
+        vectors = np.array(result["embedding"], dtype=np.float32).reshape(len(texts), -1)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.tolist()
+
+
+class _Pending:
+    __slots__ = ("text", "future")
+
+    def __init__(self, text: str, future: asyncio.Future):
+        self.text = text
+        self.future = future
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """SentenceTransformer model run on the local CPU.
+
+    The model is loaded on first use. Concurrent calls are coalesced: a dispatcher
+    drains the queue (queries ahead of ingest) into batches of up to max_batch_size,
+    waiting at most max_wait_ms for a batch to fill, and runs each forward pass on a
+    worker thread so the event loop stays free. With backend="onnx" the model runs on
+    ONNX Runtime (sentence-transformers >= 3.2 with the onnx extra).
+    """
+
+    def __init__(self, model: Optional[str] = None, dimensions: Optional[int] = None,
+                 max_batch_size: int = LOCAL_EMBED_BATCH_SIZE, max_wait_ms: float = LOCAL_EMBED_MAX_WAIT_MS,
+                 workers: int = LOCAL_EMBED_WORKERS, backend: str = LOCAL_EMBED_BACKEND):
+        self.model = model or "emilyalsentzer/Bio_ClinicalBERT"
+        self.dimensions = dimensions or 768
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.backend = backend
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="local-embed")
+        self._slots = None
+        self._workers = workers
+        self._encoder = None
+        self._load_lock = threading.Lock()
+        self._queue = None
+        self._dispatcher = None
+        self._running = set()
+        self._sequence = itertools.count()
+
+    def _load(self):
+        with self._load_lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer
+
+                if LOCAL_EMBED_THREADS:
+                    import torch
+                    torch.set_num_threads(LOCAL_EMBED_THREADS)
+                options = {"backend": "onnx"} if self.backend == "onnx" else {}
+                encoder = SentenceTransformer(self.model, device="cpu", **options)
+                dims = encoder.get_sentence_embedding_dimension()
+                if dims != self.dimensions:
+                    raise RuntimeError(f"{self.model} produces {dims}-dim vectors, configured for {self.dimensions}")
+                self._encoder = encoder
+        return self._encoder
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        encoder = self._encoder or self._load()
+        vectors = encoder.encode(texts, batch_size=len(texts), normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.tolist()
+
+    async def embed(self, texts, token_counts=None, priority=BULK):
+        if not texts:
+            return []
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._slots = asyncio.Semaphore(self._workers)
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        loop = asyncio.get_running_loop()
+        pending = [_Pending(text, loop.create_future()) for text in texts]
+        for item in pending:
+            self._queue.put_nowait((priority, next(self._sequence), item))
+        return list(await asyncio.gather(*[item.future for item in pending]))
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Only form a batch once a worker is free, so requests keep joining it meanwhile
+            await self._slots.acquire()
+            batch = [(await self._queue.get())[2]]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append((await asyncio.wait_for(self._queue.get(), remaining))[2])
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait()[2])
+            task = asyncio.create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[_Pending]):
+        loop = asyncio.get_running_loop()
+        try:
+            vectors = await loop.run_in_executor(self._pool, self._encode, [item.text for item in batch])
+            for item, vector in zip(batch, vectors):
+                if not item.future.done():
+                    item.future.set_result(vector)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    async def aclose(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        self._pool.shutdown(wait=False)
+
+
+PROVIDERS = {
+    "openai": OpenAIEmbeddingProvider,
+    "gemini": GeminiEmbeddingProvider,
+    "local": LocalEmbeddingProvider,
+}
+
+
+def create_provider(name: str, model: Optional[str] = None, dimensions: Optional[int] = None,
+                    **options) -> EmbeddingProvider:
+    """Provider selected by Config.embedding_provider / EMBEDDING_PROVIDER."""
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown embedding provider {name!r}, expected one of {', '.join(PROVIDERS)}")
+    return PROVIDERS[name](model=model, dimensions=dimensions, **options)
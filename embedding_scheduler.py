@@ -0,0 +1,204 @@
+import asyncio
+import os
+import random
+import time
+from typing import List, Optional
+
+import httpx
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+EMBED_RPM = int(os.getenv("EMBED_RPM", "3000"))  # provider requests/min limit
+EMBED_TPM = int(os.getenv("EMBED_TPM", "1000000"))  # provider tokens/min limit
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))  # requests in flight
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+BULK_RESERVE = 0.1  # share of each rate budget that bulk ingest leaves for interactive queries
+
+INTERACTIVE = 0
+BULK = 1
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Continuously refilling budget of `rate_per_minute` units."""
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float, reserve: float = 0.0):
+        """Take `amount` units, waiting until that leaves at least `reserve` of the capacity unspent."""
+        amount = min(amount, self.capacity * (1 - reserve))
+        while True:
+            # Sleep outside the lock so a waiting bulk batch doesn't hold up interactive callers
+            async with self._lock:
+                self._refill()
+                shortfall = amount + self.capacity * reserve - self.level
+                if shortfall <= 0:
+                    self.level -= amount
+                    return
+            await asyncio.sleep(shortfall / self.rate)
+
+    def drain(self):
+        """Empty the bucket, e.g. after the provider answered 429."""
+        self._refill()
+        self.level = 0.0
+
+
+class _Request:
+    __slots__ = ("text", "tokens", "future")
+
+    def __init__(self, text: str, tokens: int, future: asyncio.Future):
+        self.text = text
+        self.tokens = tokens
+        self.future = future
+
+
+class EmbeddingScheduler:
+    """Shared gateway for every embeddings call made by the API.
+
+    Requests are queued per priority and coalesced into multi-input batches. Batches go
+    out over one pooled HTTP client, paced by token buckets on requests/min and
+    tokens/min, and are retried with jittered exponential backoff on 429/5xx.
+    Interactive (query) requests have their own dispatcher, and bulk ingest can never
+    take the last in-flight slot or the reserved share of the rate budgets, so a large
+    upload cannot starve live queries.
+    """
+
+    def __init__(self, model: str, api_key: str = OPENAI_API_KEY, dimensions: Optional[int] = None,
+                 max_batch_size: int = 128, max_batch_tokens: int = 300000,
+                 rpm: int = EMBED_RPM, tpm: int = EMBED_TPM,
+                 max_concurrency: int = EMBED_MAX_CONCURRENCY, max_retries: int = EMBED_MAX_RETRIES):
+        self.model = model
+        self.api_key = api_key
+        self.dimensions = dimensions
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max(2, max_concurrency)
+        self.max_retries = max_retries
+        self.requests_per_minute = TokenBucket(rpm)
+        self.tokens_per_minute = TokenBucket(tpm)
+        self._http = httpx.AsyncClient(
+            base_url=OPENAI_BASE_URL,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+        )
+        self._queues = None
+        self._dispatchers = []
+        self._running = set()
+
+    def _start(self):
+        if self._queues is None:
+            self._queues = {INTERACTIVE: asyncio.Queue(), BULK: asyncio.Queue()}
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._bulk_slots = asyncio.Semaphore(self.max_concurrency - 1)
+            self._dispatchers = [
+                asyncio.create_task(self._dispatch(INTERACTIVE)),
+                asyncio.create_task(self._dispatch(BULK)),
+            ]
+
+    async def embed(self, texts: List[str], token_counts: Optional[List[int]] = None,
+                    priority: int = BULK) -> List[List[float]]:
+        if not texts:
+            return []
+        self._start()
+        loop = asyncio.get_running_loop()
+        if token_counts is None:
+            token_counts = [len(text) // 4 + 1 for text in texts]
+        requests = [_Request(text, tokens, loop.create_future()) for text, tokens in zip(texts, token_counts)]
+        for request in requests:
+            self._queues[priority].put_nowait(request)
+        return list(await asyncio.gather(*[r.future for r in requests]))
+
+    async def embed_one(self, text: str, tokens: Optional[int] = None, priority: int = INTERACTIVE) -> List[float]:
+        return (await self.embed([text], None if tokens is None else [tokens], priority))[0]
+
+    async def _dispatch(self, priority: int):
+        queue = self._queues[priority]
+        reserve = BULK_RESERVE if priority == BULK else 0.0
+        carry = None
+        while True:
+            if priority == BULK:
+                await self._bulk_slots.acquire()
+            first = carry or await queue.get()
+            carry = None
+            batch, batch_tokens = [first], first.tokens
+            while not queue.empty() and len(batch) < self.max_batch_size:
+                nxt = queue.get_nowait()
+                if batch_tokens + nxt.tokens > self.max_batch_tokens:
+                    carry = nxt
+                    break
+                batch.append(nxt)
+                batch_tokens += nxt.tokens
+            await self._slots.acquire()
+            await self.requests_per_minute.acquire(1, reserve)
+            await self.tokens_per_minute.acquire(batch_tokens, reserve)
+            task = asyncio.create_task(self._run(batch, priority))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[_Request], priority: int):
+        try:
+            vectors = await self._send([r.text for r in batch])
+            for request, vector in zip(batch, vectors):
+                if not request.future.done():
+                    request.future.set_result(vector)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self._slots.release()
+            if priority == BULK:
+                self._bulk_slots.release()
+
+    async def _send(self, inputs: List[str]) -> List[List[float]]:
+        body = {"model": self.model, "input": inputs}
+        if self.dimensions:
+            body["dimensions"] = self.dimensions
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = await self._http.post(
+                    "/embeddings",
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    json=body,
+                )
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            if resp.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                delay = self._backoff(attempt)
+                if resp.status_code == 429:
+                    self.tokens_per_minute.drain()
+                    retry_after = resp.headers.get("retry-after")
+                    if retry_after:
+                        try:
+                            delay = max(delay, float(retry_after))
+                        except ValueError:
+                            pass
+                await asyncio.sleep(delay)
+                continue
+            resp.raise_for_status()
+            data = sorted(resp.json()["data"], key=lambda d: d["index"])
+            return [d["embedding"] for d in data]
+
+    @staticmethod
+    def _backoff(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+        # Full jitter: spreads retries from concurrent batches instead of synchronizing them
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+    async def aclose(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await self._http.aclose()
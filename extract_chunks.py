@@ -1,37 +1,194 @@
 import fitz
+import io
+import multiprocessing
 import os
-from pdf2image import convert_from_path
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple, Union
+
 import pytesseract
+import tiktoken
+from PIL import Image
+
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "256"))  # tokens per chunk
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100"))  # tokens repeated from the previous chunk
+SECTION_MARKER = "Test Report"  # a block starting with this always starts a new chunk
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+PARALLEL_EXTRACT_MIN_PAGES = int(os.getenv("PARALLEL_EXTRACT_MIN_PAGES", "32"))
+
+if CHUNK_OVERLAP >= CHUNK_SIZE:
+    raise ValueError(f"CHUNK_OVERLAP ({CHUNK_OVERLAP}) must be smaller than CHUNK_SIZE ({CHUNK_SIZE})")
+
+_worker_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_worker_pool() -> ProcessPoolExecutor:
+    global _worker_pool
+    if _worker_pool is None:
+        # forkserver: the pool is first created from a thread of the threaded API server,
+        # and forking a process whose other threads hold locks can deadlock the child
+        _worker_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    return _worker_pool
+
+
+def set_pdf_workers(count: int):
+    """Size of this process's extraction pool; set in processes that are workers themselves."""
+    global PDF_WORKERS
+    PDF_WORKERS = count
+
+
+def shutdown_worker_pool():
+    """Stop the worker processes; the next extraction starts a fresh pool."""
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool.shutdown(wait=True)
+        _worker_pool = None
+
+
+def open_pdf(source: Union[str, bytes]):
+    """Open a PDF from a path or straight from an in-memory upload buffer."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
 
-def extract_text_with_ocr(pdf_path: str) -> str:
-    images = convert_from_path(pdf_path)
-    full_text = ""
-    for image in images:
-        text = pytesseract.image_to_string(image)
-        full_text += text + "\n"
-    return full_text
+def page_blocks(page) -> List[str]:
+    """Text blocks of a page in reading order. PyMuPDF's blocks follow the layout
+    (paragraphs, table rows), so they are the units chunks are assembled from."""
+    blocks = []
+    for block in page.get_text("blocks", sort=True):
+        text = block[4].strip()
+        if block[6] == 0 and text:
+            blocks.append(text)
+    return blocks
 
 
-def extract_chunks_from_pdf(pdf_path: str):
-    doc = fitz.open(pdf_path)
-    full_text = "".join([page.get_text() for page in doc])
+def _extract_page_range(source: Union[str, bytes], start: int, stop: int) -> List[List[str]]:
+    with open_pdf(source) as doc:
+        return [page_blocks(doc[i]) for i in range(start, stop)]
 
-    # OCR fallback if no extractable text
-    if not full_text.strip():
-        full_text = extract_text_with_ocr(pdf_path)
 
-    # Simple chunking logic
-    parts = full_text.split("Test Report")
+def extract_page_blocks(doc, source: Union[str, bytes]) -> List[List[str]]:
+    """Text blocks of every page, extracted exactly once.
+
+    Documents with at least PARALLEL_EXTRACT_MIN_PAGES pages are split into
+    contiguous page ranges extracted by the worker processes. An upload held in
+    memory is written to one temporary file for them, so each task carries a path
+    instead of a pickled copy of the whole PDF.
+    """
+    page_count = doc.page_count
+    if page_count < PARALLEL_EXTRACT_MIN_PAGES or PDF_WORKERS < 2:
+        return [page_blocks(page) for page in doc]
+    step = -(-page_count // PDF_WORKERS)
+    pool = _get_worker_pool()
+    spilled = None
+    if not isinstance(source, str):
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(source)
+        source = spilled = f.name
+    try:
+        futures = [
+            pool.submit(_extract_page_range, source, start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ]
+        return [text for future in futures for text in future.result()]
+    finally:
+        if spilled:
+            os.unlink(spilled)
+
+
+def _ocr_image(png: bytes) -> str:
+    return pytesseract.image_to_string(Image.open(io.BytesIO(png)))
+
+
+def ocr_pages(doc, page_numbers: List[int]) -> Dict[int, str]:
+    """OCR the given pages across the worker pool.
+
+    Pages are rasterized one at a time as workers free up, so at most
+    2 * PDF_WORKERS page images are held in memory at once. With a single
+    worker the pages are OCRed in this process.
+    """
+    if PDF_WORKERS < 2:
+        return {n: _ocr_image(doc[n].get_pixmap(dpi=OCR_DPI).tobytes("png")) for n in page_numbers}
+    pool = _get_worker_pool()
+    max_in_flight = 2 * PDF_WORKERS
+    results = {}
+    pending = {}
+    for n in page_numbers:
+        if len(pending) >= max_in_flight:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+        png = doc[n].get_pixmap(dpi=OCR_DPI).tobytes("png")
+        pending[pool.submit(_ocr_image, png)] = n
+    for future in wait(pending).done:
+        results[pending[future]] = future.result()
+    return results
+
+
+def chunk_blocks(blocks: List[str], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Pack layout blocks into chunks of at most chunk_size tokens.
+
+    Consecutive chunks share up to chunk_overlap tokens of trailing whole blocks, blocks
+    longer than a chunk are split on token windows, and a SECTION_MARKER block starts a
+    fresh chunk. Identical chunks are emitted once.
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+    enc = tiktoken.get_encoding("cl100k_base")
     chunks = []
-    for section in parts[1:]:
-        if "Test Name" in section:
-            chunks.append(section.strip())
+    current: List[Tuple[str, int]] = []
+    current_tokens = 0
+
+    def emit():
+        text = "\n".join(block for block, _ in current)
+        if text and (not chunks or chunks[-1] != text):
+            chunks.append(text)
+
+    for block in blocks:
+        tokens = enc.encode(block, disallowed_special=())
+        if len(tokens) > chunk_size:
+            pieces = []
+            step = chunk_size - chunk_overlap
+            for start in range(0, len(tokens), step):
+                pieces.append((enc.decode(tokens[start:start + chunk_size]), min(chunk_size, len(tokens) - start)))
+                if start + chunk_size >= len(tokens):
+                    break
+        else:
+            pieces = [(block, len(tokens))]
+        for text, count in pieces:
+            if current and (current_tokens + count > chunk_size or text.startswith(SECTION_MARKER)):
+                emit()
+                if text.startswith(SECTION_MARKER):
+                    current, current_tokens = [], 0
+                else:
+                    # Carry trailing blocks over as overlap
+                    kept = []
+                    kept_tokens = 0
+                    for prev in reversed(current):
+                        if kept_tokens + prev[1] > chunk_overlap or kept_tokens + prev[1] + count > chunk_size:
+                            break
+                        kept.insert(0, prev)
+                        kept_tokens += prev[1]
+                    current, current_tokens = kept, kept_tokens
+            current.append((text, count))
+            current_tokens += count
+    emit()
+    return list(dict.fromkeys(chunks))
+
+
+def extract_chunks_from_pdf(source: Union[str, bytes]):
+    """Chunk a PDF given as a file path or as the raw bytes of an upload."""
+    with open_pdf(source) as doc:
+        pages = extract_page_blocks(doc, source)
 
-    # fallback to page-wise
-    if not chunks:
-        for page in doc:
-            txt = page.get_text().strip()
-            if txt:
-                chunks.append(txt)
+        # OCR fallback for pages without an extractable text layer
+        empty = [i for i, blocks in enumerate(pages) if not blocks]
+        if empty:
+            for i, text in ocr_pages(doc, empty).items():
+                pages[i] = [para.strip() for para in text.split("\n\n") if para.strip()]
 
+    full_text = "".join("\n".join(blocks) + "\n" for blocks in pages)
+    chunks = chunk_blocks([block for blocks in pages for block in blocks])
     return chunks, full_text
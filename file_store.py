@@ -1,25 +1,100 @@
+import base64
+import logging
 import os
-import json
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
-META_DIR = "storage/metadata"
-os.makedirs(META_DIR, exist_ok=True)
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
-def store_metadata(user_id: str, filename: str, num_chunks: int, summary=""):
-    meta_file = os.path.join(META_DIR, f"{user_id}.json")
-    data = []
+from database import mongo_db
 
-    if os.path.exists(meta_file):
-        with open(meta_file, "r") as f:
-            data = json.load(f)
+FILES_PAGE_SIZE = int(os.getenv("FILES_PAGE_SIZE", "100"))  # /list_documents/ entries per page
+FILES_MAX_PAGE_SIZE = 1000
+FILE_FIELDS = {"filename": 1, "timestamp": 1, "num_chunks": 1}
 
-    entry = {
-        "filename": filename,
-        "timestamp": datetime.now().isoformat(),
-        "num_chunks": num_chunks,
-        "summary": summary
-    }
-    data.append(entry)
+logger = logging.getLogger(__name__)
 
-    with open(meta_file, "w") as f:
-        json.dump(data, f, indent=2)
+# One document per (user_id, filename), the only record of a user's uploaded files
+files = mongo_db.files
+
+
+async def _drop_duplicate_entries():
+    """Keep only the newest entry per (user_id, filename); uploads used to insert one each."""
+    duplicates = files.aggregate([
+        {"$sort": {"timestamp": -1, "_id": -1}},
+        {"$group": {"_id": {"user_id": "$user_id", "filename": "$filename"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True)
+    async for group in duplicates:
+        await files.delete_many({"_id": {"$in": group["ids"][1:]}})
+
+
+async def migrate_file_entries():
+    """One-off (migrate_files.py): drop duplicate entries and replace the non-unique
+    (user_id, filename) index earlier versions created under the same name."""
+    await _drop_duplicate_entries()
+    existing = (await files.index_information()).get("user_id_1_filename_1")
+    if existing and not existing.get("unique"):
+        await files.drop_index("user_id_1_filename_1")
+    await ensure_file_indexes()
+
+
+async def ensure_file_indexes():
+    try:
+        # Unique, so concurrent first uploads of a file cannot both insert
+        await files.create_index([("user_id", 1), ("filename", 1)], unique=True)
+    except OperationFailure as e:
+        # Duplicate entries or the old non-unique index; uploads still work without it
+        logger.warning(f"Could not create unique index on files (user_id, filename), run migrate_files.py: {e}")
+    # Newest-first listing; _id breaks timestamp ties so page cursors are exact
+    await files.create_index([("user_id", 1), ("timestamp", -1), ("_id", -1)])
+
+
+async def store_metadata(user_id: str, filename: str, num_chunks: int, summary="") -> datetime:
+    """Record an indexed upload. A single upsert, so concurrent uploads never rewrite each
+    other's entries and a re-upload replaces the file's entry instead of duplicating it."""
+    timestamp = datetime.utcnow()
+    query = {"user_id": user_id, "filename": filename}
+    update = {"$set": {"timestamp": timestamp, "num_chunks": num_chunks, "summary": summary}}
+    try:
+        await files.update_one(query, update, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent upload inserted the entry first; it exists now, so update it
+        await files.update_one(query, update)
+    return timestamp
+
+
+def _encode_cursor(entry: Dict) -> str:
+    return base64.urlsafe_b64encode(f"{entry['timestamp'].isoformat()}|{entry['_id']}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    timestamp, _id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(timestamp), ObjectId(_id)
+
+
+async def list_metadata(user_id: str, cursor: Optional[str] = None,
+                        limit: int = FILES_PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+    """One page of the user's files, newest first, and the cursor of the next page (None at
+    the end). Pages are read by seeking the (user_id, timestamp, _id) index past the cursor,
+    so each page costs the same however many files come before it."""
+    limit = max(1, min(limit, FILES_MAX_PAGE_SIZE))
+    query = {"user_id": user_id}
+    if cursor:
+        timestamp, _id = _decode_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": _id}},
+        ]
+    found = files.find(query, FILE_FIELDS).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1)
+    entries = await found.to_list(length=limit + 1)
+    next_cursor = _encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+    entries = entries[:limit]
+    for entry in entries:
+        entry["_id"] = str(entry["_id"])
+    return entries, next_cursor
+
+
+async def delete_metadata(user_id: str, filename: str):
+    await files.delete_many({"user_id": user_id, "filename": filename})
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from pymongo.errors import OperationFailure
+
+from answer_cache import answer_cache
+from database import mongo_db
+import extract_chunks
+from extract_chunks import extract_chunks_from_pdf
+from file_store import store_metadata
+from lab_store import save_lab_results
+from qdrant_store import build_points, delete_points, diff_document, upsert_points
+from structured_parser import parse_lab_report
+
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+INGEST_JOB_TTL = int(os.getenv("INGEST_JOB_TTL", str(7 * 24 * 3600)))  # seconds a job is kept for /jobs/{id}
+INGEST_JOB_HEARTBEAT = int(os.getenv("INGEST_JOB_HEARTBEAT", "30"))  # seconds between liveness writes of a running job
+# A job not heard from in this long was running on a worker that has since stopped
+INGEST_JOB_STALE = 3 * INGEST_JOB_HEARTBEAT
+INTERRUPTED_ERROR = "Ingestion was interrupted by a server restart; upload the file again."
+
+logger = logging.getLogger(__name__)
+
+# One document per upload, {_id: job id, user_id, status, created_at, finished_at, heartbeat_at,
+# files}; shared by every API worker, so /jobs/{id} answers on any of them
+jobs = mongo_db.ingest_jobs
+
+# The parse pool is shared by all jobs, so it bounds how many documents are open at once
+# no matter how many uploads are queued. Each document is parsed in one of its worker
+# processes: PyMuPDF holds the GIL and is not safe to use from several threads. Large
+# documents and OCR fan out further from there, over that worker's share of PDF_WORKERS.
+# Embedding (through the shared embedding scheduler), Qdrant upserts and metadata writes
+# are async and run on the event loop.
+_parse_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    if _parse_pool is None:
+        # forkserver, as for extract_chunks' pool: forking the threaded API server can deadlock
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=INGEST_PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=extract_chunks.set_pdf_workers,
+            initargs=(max(1, extract_chunks.PDF_WORKERS // INGEST_PARSE_WORKERS),),
+        )
+    return _parse_pool
+
+
+def shutdown_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=True)
+        _parse_pool = None
+
+
+_running = set()  # strong references so running job tasks are not garbage collected
+
+
+async def ensure_job_indexes():
+    try:
+        await jobs.create_index("created_at", expireAfterSeconds=INGEST_JOB_TTL)
+    except OperationFailure:
+        # The index exists with another TTL (INGEST_JOB_TTL changed): update it in place
+        try:
+            await mongo_db.command({
+                "collMod": jobs.name,
+                "index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": INGEST_JOB_TTL},
+            })
+        except OperationFailure as e:
+            logger.warning(f"Could not update the ingest_jobs TTL index: {e}")
+
+
+def _public(doc: Dict) -> Dict:
+    job = dict(doc, job_id=doc["_id"])
+    del job["_id"]
+    return job
+
+
+async def create_job(user_id: str, uploads: List[Tuple[str, bytes]]) -> Dict:
+    now = datetime.utcnow()
+    doc = {
+        "_id": uuid4().hex,
+        "user_id": user_id,
+        "status": "queued",
+        "created_at": now,
+        "finished_at": None,
+        "heartbeat_at": now,
+        "files": [{"filename": filename, "status": "queued"} for filename, _ in uploads],
+    }
+    await jobs.insert_one(doc)
+
+    task = asyncio.create_task(_run_job(doc, uploads))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return _public(doc)
+
+
+async def get_job(job_id: str, user_id: str) -> Optional[Dict]:
+    doc = await jobs.find_one({"_id": job_id, "user_id": user_id})
+    if doc is None:
+        return None
+    if doc["status"] != "completed" and doc["heartbeat_at"] < datetime.utcnow() - timedelta(seconds=INGEST_JOB_STALE):
+        # The upload bytes were only held by the worker that stopped: report the files as
+        # failed so clients stop waiting, instead of leaving the job queued forever
+        for entry in doc["files"]:
+            if entry["status"] not in ("indexed", "failed", "error"):
+                entry["status"] = "error"
+                entry["error"] = INTERRUPTED_ERROR
+        doc["status"] = "completed"
+        doc["finished_at"] = datetime.utcnow()
+        await jobs.update_one(
+            {"_id": job_id, "heartbeat_at": doc["heartbeat_at"]},
+            {"$set": {"status": doc["status"], "finished_at": doc["finished_at"], "files": doc["files"]}},
+        )
+    return _public(doc)
+
+
+async def _save_file(job_id: str, position: int, entry: Dict):
+    await jobs.update_one(
+        {"_id": job_id},
+        {"$set": {f"files.{position}": entry, "heartbeat_at": datetime.utcnow()}},
+    )
+
+
+async def _heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(INGEST_JOB_HEARTBEAT)
+        await jobs.update_one({"_id": job_id}, {"$set": {"heartbeat_at": datetime.utcnow()}})
+
+
+async def _run_job(job: Dict, uploads: List[Tuple[str, bytes]]):
+    job_id = job["_id"]
+    await jobs.update_one({"_id": job_id}, {"$set": {"status": "running", "heartbeat_at": datetime.utcnow()}})
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    try:
+        # Files go through the stages independently, so one file's embedding overlaps the
+        # next file's parsing instead of the batch moving in lockstep.
+        await asyncio.gather(*[
+            _ingest_file(job_id, job["user_id"], position, entry, data)
+            for position, (entry, (_, data)) in enumerate(zip(job["files"], uploads))
+        ])
+    finally:
+        heartbeat.cancel()
+    await jobs.update_one(
+        {"_id": job_id},
+        {"$set": {"status": "completed", "finished_at": datetime.utcnow(), "heartbeat_at": datetime.utcnow()}},
+    )
+
+
+async def _ingest_file(job_id: str, user_id: str, position: int, entry: Dict, data: bytes):
+    loop = asyncio.get_running_loop()
+    filename = entry["filename"]
+    try:
+        entry["status"] = "extracting"
+        await _save_file(job_id, position, entry)
+        chunks, full_text = await loop.run_in_executor(_get_parse_pool(), extract_chunks_from_pdf, data)
+
+        if not chunks:
+            entry["status"] = "failed"
+            entry["error"] = "No text chunks extracted."
+            return
+
+        entry["status"] = "embedding"
+        entry["num_chunks"] = len(chunks)
+        await _save_file(job_id, position, entry)
+        # Structured results are parsed on the parse pool while the chunks are embedded
+        labs = loop.run_in_executor(_get_parse_pool(), parse_lab_report, full_text, datetime.utcnow())
+        try:
+            # Re-uploads only embed chunks that are not indexed yet
+            new_positions, stale = await diff_document(user_id, filename, chunks)
+            entry["new_chunks"] = len(new_positions)
+            points = await build_points(filename, filename, [chunks[i] for i in new_positions], user_id, new_positions)
+
+            entry["status"] = "upserting"
+            await _save_file(job_id, position, entry)
+            await upsert_points(points)
+            await delete_points(stale)
+            entry["removed_chunks"] = len(stale)
+        except Exception:
+            # Nothing will read the parse now; drop it if it hasn't started
+            labs.cancel()
+            raise
+        await save_lab_results(user_id, filename, await labs)
+        await answer_cache.bump_version(user_id)
+        # summary = summarize_chunks(chunks)
+        timestamp = await store_metadata(user_id, filename, len(chunks), "")
+        entry["status"] = "indexed"
+        entry["timestamp"] = timestamp
+    except Exception as e:
+        traceback.print_exc()
+        entry["status"] = "error"
+        entry["error"] = str(e)
+    finally:
+        await _save_file(job_id, position, entry)
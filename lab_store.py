@@ -0,0 +1,47 @@
+from typing import Dict, List
+
+from database import mongo_db
+
+# One document per extracted test result:
+# {user_id, filename, report_date, test_name, test_key, value, unit, ref_range, flag}
+lab_results = mongo_db.lab_results
+
+
+async def ensure_lab_indexes():
+    await lab_results.create_index([("user_id", 1), ("report_date", 1)])
+    await lab_results.create_index([("user_id", 1), ("filename", 1)])
+    # Time-series index: one test's results for a user, already in report order
+    await lab_results.create_index([("user_id", 1), ("test_key", 1), ("report_date", 1)])
+
+
+async def save_lab_results(user_id: str, filename: str, rows: List[Dict]):
+    """Replace the stored results of one report."""
+    await lab_results.delete_many({"user_id": user_id, "filename": filename})
+    if rows:
+        await lab_results.insert_many([dict(row, user_id=user_id, filename=filename) for row in rows])
+
+
+async def load_lab_results(user_id: str) -> List[Dict]:
+    """Every stored result of the user, oldest report first."""
+    cursor = lab_results.find({"user_id": user_id}, {"_id": 0, "user_id": 0}).sort([("report_date", 1), ("filename", 1)])
+    return await cursor.to_list(length=None)
+
+
+async def delete_lab_results(user_id: str, filename: str):
+    await lab_results.delete_many({"user_id": user_id, "filename": filename})
+
+
+async def user_test_keys(user_id: str) -> List[str]:
+    return await lab_results.distinct("test_key", {"user_id": user_id})
+
+
+async def load_series(user_id: str, test_keys: List[str]) -> Dict[str, List[Dict]]:
+    """Complete history of each test, oldest report first, read off the time-series index."""
+    cursor = lab_results.find(
+        {"user_id": user_id, "test_key": {"$in": test_keys}},
+        {"_id": 0, "test_key": 1, "test_name": 1, "report_date": 1, "value": 1, "unit": 1, "ref_range": 1, "filename": 1},
+    ).sort([("test_key", 1), ("report_date", 1)])
+    series = {}
+    async for row in cursor:
+        series.setdefault(row["test_key"], []).append(row)
+    return series
@@ -1,3 +1,62 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import tiktoken
+
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))  # retrieved context per prompt
+DEDUP_SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", "0.9"))  # shared share of word shingles that marks a duplicate
+
+try:
+    _encoding = tiktoken.encoding_for_model(CHAT_MODEL)
+except KeyError:
+    _encoding = tiktoken.get_encoding("cl100k_base")
+# Stored with each chunk's token_count, so counts made with another tokenizer are not trusted
+TOKEN_ENCODING = _encoding.name
+
+_WORD = re.compile(r"\w+")
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _shingles(text: str, size: int = 3) -> frozenset:
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return frozenset([" ".join(words)])
+    return frozenset(" ".join(words[i:i + size]) for i in range(len(words) - size + 1))
+
+
+def pack_context(hits: List[Dict], budget: int = CONTEXT_TOKEN_BUDGET,
+                 similarity: float = DEDUP_SIMILARITY) -> Tuple[List[Dict], int]:
+    """Select ranked hits for the prompt: skip near-duplicates of an already selected chunk
+    and stop adding once `budget` tokens are used. Returns (selected hits, tokens used).
+
+    Token counts come from the payload stored at ingest, in the chat model's encoding,
+    and are only computed here for points indexed without one.
+    """
+    selected = []
+    selected_shingles = []
+    used = 0
+    for hit in hits:
+        shingles = _shingles(hit["text"])
+        # Overlap relative to the smaller chunk, so a chunk contained in another also counts
+        if any(len(shingles & other) / min(len(shingles), len(other)) >= similarity for other in selected_shingles):
+            continue
+        tokens = hit.get("token_count")
+        if tokens is None:
+            tokens = count_tokens(hit["text"])
+        if used + tokens > budget:
+            # A lower ranked but shorter chunk may still fit
+            continue
+        selected.append(hit)
+        selected_shingles.append(shingles)
+        used += tokens
+    return selected, used
+
+
 def build_prompt(question: str, chunks: list[str]) -> str:
     context = "\n\n".join(chunks)
     return f"""You are a medical assistant. Based only on the following medical test report text, answer the question precisely.
@@ -37,4 +96,35 @@ Now answer the following question based on the historical data provided:
 Question: {question}
 Answer:"""
 
-    return prompt
\ No newline at end of file
+    return prompt
+
+
+def format_series_table(series: Dict[str, List[Dict]]) -> str:
+    """One compact table per test, one row per report in date order."""
+    blocks = []
+    for rows in series.values():
+        lines = [f"{rows[-1]['test_name']} (unit: {rows[-1]['unit'] or '-'}, reference: {rows[-1]['ref_range'] or '-'})",
+                 "date | value"]
+        for row in rows:
+            date = row["report_date"].strftime("%Y-%m-%d") if row.get("report_date") else row["filename"]
+            lines.append(f"{date} | {row['value']:g}")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def build_prompt_trends(question: str, table: str, grouped_chunks: Optional[dict] = None) -> str:
+    excerpts = ""
+    if grouped_chunks:
+        excerpts = "\n\nExcerpts from their reports that may also be relevant:\n\n" + "\n\n".join(
+            f"--- Report: {fname} ---\n" + "\n".join(grouped_chunks[fname]) for fname in sorted(grouped_chunks))
+    return f"""
+You are a medical assistant helping a patient understand their lab report history.
+
+Below is the complete history of the tests their question is about, one row per report, oldest first:
+
+{table}{excerpts}
+
+Now answer the following question based on the historical data provided:
+
+Question: {question}
+Answer:"""
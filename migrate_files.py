@@ -0,0 +1,8 @@
+import asyncio
+
+from file_store import migrate_file_entries
+
+# Removes duplicate (user_id, filename) entries left by earlier versions, keeping the
+# newest, and makes their index unique. Run once before deploying; the API only
+# creates the indexes at startup.
+asyncio.run(migrate_file_entries())
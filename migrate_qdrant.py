@@ -0,0 +1,7 @@
+import asyncio
+
+from qdrant_store import init_collection
+
+# Creates the collection if missing, otherwise adds the payload indexes and
+# per-tenant HNSW settings to an existing one. The API also does this at startup.
+asyncio.run(init_collection())
@@ -1,112 +1,186 @@
 import os
 import hashlib
 from datetime import datetime
-from typing import List, Dict
+import uuid
+from typing import List, Dict, Optional, Set, Tuple, Union
 from fastapi.responses import JSONResponse
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.models import (
     VectorParams,
     Distance,
     PointStruct,
     Filter,
     FieldCondition,
-    MatchValue
+    MatchValue,
+    HnswConfigDiff,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParamsDiff,
+    PointIdsList,
+    PayloadSchemaType
 )
 
 from openai import OpenAI
 import tiktoken
 import asyncio
-import httpx
+
+from embedding_cache import EmbeddingCache
+from embedding_providers import create_provider
+from embedding_scheduler import BULK, INTERACTIVE
+from llm_prompter import TOKEN_ENCODING, count_tokens
+from query_cache import query_embedding_cache
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 COLLECTION = os.getenv("QDRANT_COLLECTION", "medical_reports")
-EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
-EMBED_DIM = 1536  # text-embedding-3-small
-
-client = QdrantClient(url=QDRANT_URL)
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")  # "openai", "gemini" or "local"
+# text-embedding-3 models can return shortened vectors; changing this needs a fresh collection
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0")) or None  # default: the model's own size
+EMBED_MAX_TOKENS = 8192  # per input
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))  # inputs per embeddings request
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "300000"))  # tokens per embeddings request
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "0") == "1"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+# Every search is filtered by user_id, so by default the collection skips the global HNSW
+# graph (m=0) and builds one graph per indexed payload value instead (payload_m).
+QDRANT_MULTITENANT = os.getenv("QDRANT_MULTITENANT", "1") == "1"
+TENANT_HNSW = HnswConfigDiff(payload_m=16, m=0)
+PAYLOAD_INDEXES = ("user_id", "filename", "patient_id")
+# "int8": int8 copies of the vectors stay in RAM for search, the float32 originals move to
+# disk and only the top QDRANT_OVERSAMPLING * limit candidates are rescored against them
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none")
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", "2.0"))
+QUANTIZED = QDRANT_QUANTIZATION == "int8"
+INT8_QUANTIZATION = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+)
+SEARCH_PARAMS = SearchParams(
+    quantization=QuantizationSearchParams(rescore=True, oversampling=QDRANT_OVERSAMPLING)
+) if QUANTIZED else None
+
+# One client for the whole process: it keeps its HTTP/gRPC connections open and reuses them
+client = AsyncQdrantClient(url=QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT)
+_collection_ready = False
+_collection_lock = asyncio.Lock()
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
+embedding_cache = EmbeddingCache()
+embedding_provider = create_provider(
+    EMBEDDING_PROVIDER,
+    model=os.getenv("EMBED_MODEL"),
+    dimensions=EMBED_DIMENSIONS,
+    **({"max_batch_size": EMBED_BATCH_SIZE, "max_batch_tokens": EMBED_BATCH_TOKENS} if EMBEDDING_PROVIDER == "openai" else {}),
+)
+EMBED_MODEL = embedding_provider.model
+EMBED_DIM = embedding_provider.dimensions
 
 
-def truncate_to_token_limit(text: str, max_tokens: int = 8192, model: str = "text-embedding-3-small") -> str:
+def truncate_with_token_count(text: str, max_tokens: int = EMBED_MAX_TOKENS) -> Tuple[str, int]:
     enc = tiktoken.get_encoding("cl100k_base")
     tokens = enc.encode(text)
     if len(tokens) > max_tokens:
         tokens = tokens[:max_tokens]
-        return enc.decode(tokens)
-    return text
+        return enc.decode(tokens), max_tokens
+    return text, len(tokens)
 
-def ensure_collection():
-    cols = [c.name for c in client.get_collections().collections]
-    if COLLECTION not in cols:
-        client.recreate_collection(
+def truncate_to_token_limit(text: str, max_tokens: int = 8192, model: str = "text-embedding-3-small") -> str:
+    return truncate_with_token_count(text, max_tokens)[0]
+
+async def init_collection():
+    """Create the collection if missing and check its vector schema. Runs once at startup;
+    later calls return immediately."""
+    global _collection_ready
+    async with _collection_lock:
+        if _collection_ready:
+            return
+        cols = [c.name for c in (await client.get_collections()).collections]
+        if COLLECTION not in cols:
+            await client.create_collection(
+                collection_name=COLLECTION,
+                vectors_config=VectorParams(size=EMBED_DIM, distance=Distance.COSINE, on_disk=True if QUANTIZED else None),
+                hnsw_config=TENANT_HNSW if QDRANT_MULTITENANT else None,
+                quantization_config=INT8_QUANTIZATION if QUANTIZED else None,
+            )
+        info = await client.get_collection(COLLECTION)
+        vectors = info.config.params.vectors
+        if isinstance(vectors, VectorParams) and vectors.size != EMBED_DIM:
+            raise RuntimeError(
+                f"Collection {COLLECTION} stores {vectors.size}-dim vectors, expected {EMBED_DIM}"
+            )
+        await migrate_collection(info)
+        _collection_ready = True
+
+async def migrate_collection(info):
+    """Bring a collection created by an older version up to the current layout:
+    keyword indexes on the filtered payload fields, in multitenant mode per-tenant HNSW and,
+    with QDRANT_QUANTIZATION=int8, quantized in-RAM vectors with on-disk originals.
+    Every step is a no-op once applied."""
+    for field in PAYLOAD_INDEXES:
+        if field not in (info.payload_schema or {}):
+            await client.create_payload_index(
+                collection_name=COLLECTION,
+                field_name=field,
+                field_schema=PayloadSchemaType.KEYWORD,
+                wait=True,
+            )
+    hnsw = info.config.hnsw_config
+    if QDRANT_MULTITENANT and (hnsw.m != TENANT_HNSW.m or hnsw.payload_m != TENANT_HNSW.payload_m):
+        # Qdrant rebuilds the HNSW graphs in the background; searches keep working meanwhile
+        await client.update_collection(collection_name=COLLECTION, hnsw_config=TENANT_HNSW)
+    if QUANTIZED and info.config.quantization_config is None:
+        # Existing points are quantized by the optimizer in the background
+        await client.update_collection(
             collection_name=COLLECTION,
-            vectors_config=VectorParams(size=EMBED_DIM, distance=Distance.COSINE),
+            vectors_config={"": VectorParamsDiff(on_disk=True)},
+            quantization_config=INT8_QUANTIZATION,
         )
 
-# from sentence_transformers import SentenceTransformer
-# import numpy as np
-
-# MODEL_NAME = "emilyalsentzer/Bio_ClinicalBERT"
+async def ensure_collection():
+    if not _collection_ready:
+        await init_collection()
 
-# embedding_model = SentenceTransformer(MODEL_NAME)
+async def get_embedding_async(text: str, priority: int = INTERACTIVE) -> List[float]:
+    return await embedding_provider.embed_one(text, priority=priority)
 
-# def get_embedding_using_fine_tuned_model(text: str) -> list[float]:
-#     """Returns a normalized embedding vector for the given text."""
-#     embedding = embedding_model.encode(text, normalize_embeddings=True)
-#     return embedding.tolist()  # Qdrant expects a list
+async def get_query_embedding(query: str) -> List[float]:
+    return await query_embedding_cache.aget_or_compute(EMBED_MODEL, EMBED_DIM, query, get_embedding_async)
 
-async def get_embedding_async(text: str) -> List[float]:
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"https://api.openai.com/v1/engines/{EMBED_MODEL}/embeddings",
-            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-            json={"input": text},
-        )
-        resp.raise_for_status()
-        return resp.json()["data"][0]["embedding"]
-
-def get_embedding(text: str) -> List[float]:
-    resp = openai_client.embeddings.create(
-        model=EMBED_MODEL,
-        input=[text],
-    )
-    return resp.data[0].embedding
+async def get_embeddings(texts: List[str], token_counts: List[int], priority: int = BULK) -> List[List[float]]:
+    """Embed many texts, serving repeats from the embedding cache and sending the rest to
+    the embedding provider, which batches them (under the rate limits, for OpenAI)."""
+    embeddings = await asyncio.to_thread(embedding_cache.get_many, EMBED_MODEL, EMBED_DIM, texts)
+    missing = [i for i, vec in enumerate(embeddings) if vec is None]
+    if missing:
+        inputs = [texts[i] for i in missing]
+        vectors = await embedding_provider.embed(inputs, [token_counts[i] for i in missing], priority)
+        for i, vec in zip(missing, vectors):
+            embeddings[i] = vec
+        await asyncio.to_thread(embedding_cache.put_many, EMBED_MODEL, EMBED_DIM, inputs, vectors)
+    return embeddings
 
 
 MAX_EMBED_CHARS = 8000  # ~4 chars per token, adjust as needed
 
-async def upsert_chunks_async(patient_id: str, filename: str, chunks: List[str], user_id: str):
-    ensure_collection()
-    timestamp = datetime.utcnow().isoformat()
-    points = []
-    # Parallel embedding
-    embeddings = await asyncio.gather(*[get_embedding_async(chunk) for chunk in chunks])
-    for i, vec in enumerate(embeddings):
-        uid = int(hashlib.md5(f"{user_id}_{filename}_{i}".encode()).hexdigest(), 16) % (10**12)
-        points.append(
-            PointStruct(
-                id=uid,
-                vector=vec,
-                payload={
-                    "patient_id": patient_id,
-                    "filename": filename,
-                    "user_id": user_id,
-                    "chunk_id": i,
-                    "text": chunks[i]
-                }
-            )
-        )
-    client.upsert(collection_name=COLLECTION, points=points)
+def chunk_point_id(user_id: str, filename: str, chunk: str) -> str:
+    """Content-derived point id: an unchanged chunk keeps its id across re-uploads."""
+    return str(uuid.UUID(hashlib.md5(f"{user_id}\x00{filename}\x00{chunk}".encode()).hexdigest()))
 
-def upsert_chunks(patient_id: str, filename: str, chunks: List[str], user_id: str):
-    ensure_collection()
+async def build_points(patient_id: str, filename: str, chunks: List[str], user_id: str,
+                       positions: Optional[List[int]] = None) -> List[PointStruct]:
     timestamp = datetime.utcnow().isoformat()
     points = []
-    for i, chunk in enumerate(chunks):
-        safe_chunk = truncate_to_token_limit(chunk, 8192, EMBED_MODEL)
-        vec = get_embedding(safe_chunk)
-        uid = int(hashlib.md5(f"{user_id}_{filename}_{i}".encode()).hexdigest(), 16) % (10**12)
+    if positions is None:
+        positions = list(range(len(chunks)))
+    truncated = await asyncio.to_thread(lambda: [truncate_with_token_count(chunk) for chunk in chunks])
+    safe_chunks = [text for text, _ in truncated]
+    # The embedding tokenizer's counts pace the embeddings API; the payload stores the
+    # chat model's, which is what the prompt budget is in
+    prompt_tokens = await asyncio.to_thread(lambda: [count_tokens(text) for text in safe_chunks])
+    vectors = await get_embeddings(safe_chunks, [n for _, n in truncated])
+    for i, chunk, safe_chunk, token_count, vec in zip(positions, chunks, safe_chunks, prompt_tokens, vectors):
+        uid = chunk_point_id(user_id, filename, chunk)
         points.append(
             PointStruct(
                 id=uid,
@@ -116,17 +190,74 @@ def upsert_chunks(patient_id: str, filename: str, chunks: List[str], user_id: st
                     "filename": filename,
                     "user_id": user_id,
                     "chunk_id": i,
-                    "text": safe_chunk
+                    "text": safe_chunk,
+                    "token_count": token_count,
+                    "token_encoding": TOKEN_ENCODING,
                 }
             )
         )
-    client.upsert(collection_name=COLLECTION, points=points)
-
-
-def search_chunks(query: str, top_k: int, user_id: str) -> List[str]:
-    ensure_collection()
-    qvec = get_embedding(query)
-    hits = client.search(
+    return points
+
+async def upsert_points(points: List[PointStruct]):
+    if not points:
+        return
+    await ensure_collection()
+    await client.upsert(collection_name=COLLECTION, points=points)
+
+async def indexed_point_ids(user_id: str, filename: str) -> Set[Union[int, str]]:
+    await ensure_collection()
+    ids = set()
+    offset = None
+    while True:
+        points, offset = await client.scroll(
+            collection_name=COLLECTION,
+            scroll_filter=Filter(
+                must=[
+                    FieldCondition(key="user_id", match=MatchValue(value=user_id)),
+                    FieldCondition(key="filename", match=MatchValue(value=filename)),
+                ]
+            ),
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        # Kept as returned: points from before content-derived ids have integer ids
+        ids.update(point.id for point in points)
+        if offset is None:
+            return ids
+
+async def diff_document(user_id: str, filename: str, chunks: List[str]) -> Tuple[List[int], List[Union[int, str]]]:
+    """Compare a (re-)uploaded document with what is indexed for it.
+
+    Returns the positions of chunks that need embedding and the ids of indexed points
+    whose chunk is gone. Points from before content-derived ids are all stale.
+    """
+    existing = await indexed_point_ids(user_id, filename)
+    ids = [chunk_point_id(user_id, filename, chunk) for chunk in chunks]
+    new_positions = [i for i, point_id in enumerate(ids) if point_id not in existing]
+    stale = list(existing.difference(ids))
+    return new_positions, stale
+
+async def delete_points(point_ids: List[Union[int, str]]):
+    if point_ids:
+        await client.delete(collection_name=COLLECTION, points_selector=PointIdsList(points=point_ids), wait=True)
+
+async def upsert_chunks(patient_id: str, filename: str, chunks: List[str], user_id: str):
+    new_positions, stale = await diff_document(user_id, filename, chunks)
+    points = await build_points(patient_id, filename, [chunks[i] for i in new_positions], user_id, new_positions)
+    await upsert_points(points)
+    await delete_points(stale)
+
+upsert_chunks_async = upsert_chunks
+
+
+async def search_chunk_hits(query: str, top_k: int, user_id: str) -> List[Dict]:
+    """Ranked hits as {"text", "filename", "token_count", "score"}; token_count is None for
+    points whose payload has no count in the chat model's encoding."""
+    await ensure_collection()
+    qvec = await get_query_embedding(query)
+    hits = await client.search(
         collection_name=COLLECTION,
         query_vector=qvec,
         query_filter=Filter(
@@ -135,39 +266,36 @@ def search_chunks(query: str, top_k: int, user_id: str) -> List[str]:
             ]
         ),
         limit=top_k,
+        search_params=SEARCH_PARAMS,
     )
-    return [h.payload["text"] for h in hits]
-
-def search_across_reports(query, top_k, user_id):
-    vector = get_embedding(query)
-
-    # Search across all vectors for this patient
-    hits = client.search(
-        collection_name="medical_reports",
-        query_vector=vector,
-        limit=top_k,
-        query_filter=Filter(
-            must=[
-                FieldCondition(key="user_id", match=MatchValue(value=user_id))
-            ]
-        )
-    )
-
+    return [
+        {
+            "text": h.payload["text"],
+            "filename": h.payload.get("filename", "unknown"),
+            "token_count": h.payload.get("token_count") if h.payload.get("token_encoding") == TOKEN_ENCODING else None,
+            "score": h.score,
+        }
+        for h in hits
+    ]
+
+async def search_chunks(query: str, top_k: int, user_id: str) -> List[str]:
+    return [hit["text"] for hit in await search_chunk_hits(query, top_k, user_id)]
+
+def group_by_report(hits: List[Dict]) -> Dict[str, List[str]]:
     grouped = {}
     for hit in hits:
-        print(hit.payload["filename"])
-        filename = hit.payload.get("filename", "unknown")
-        if filename not in grouped:
-            grouped[filename] = []
-        grouped[filename].append(hit.payload["text"])
-
+        grouped.setdefault(hit["filename"], []).append(hit["text"])
     return grouped
 
+async def search_across_reports(query, top_k, user_id):
+    # Search across all vectors for this patient
+    return group_by_report(await search_chunk_hits(query, top_k, user_id))
+
 
-def list_documents() -> List[Dict]:
-    ensure_collection()
+async def list_documents() -> List[Dict]:
+    await ensure_collection()
     docs = {}
-    scroll, next_page = client.scroll(
+    scroll, next_page = await client.scroll(
         collection_name=COLLECTION,
         with_payload=True,
         with_vectors=False,
@@ -186,9 +314,8 @@ def list_documents() -> List[Dict]:
 
 
 async def handle_delete_file(user_id: str, filename: str):
-    from database import mongo_db
     try:
-        client.delete(
+        await client.delete(
             collection_name=COLLECTION,
             points_selector=Filter(
                 must=[
@@ -198,7 +325,6 @@ async def handle_delete_file(user_id: str, filename: str):
             ),
             wait=True
         )
-        await mongo_db.files.delete_many({"user_id": user_id, "filename": filename})
 
         return {"message": f"Deleted file: {filename} for user {user_id}."}
     except Exception as e:
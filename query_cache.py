@@ -0,0 +1,106 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from embedding_cache import cache_key
+
+QUERY_CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "2048"))
+QUERY_CACHE_SINGLE_FLIGHT = os.getenv("QUERY_CACHE_SINGLE_FLIGHT", "1") == "1"
+
+
+class QueryEmbeddingCache:
+    """In-memory LRU cache of query embeddings whose entries expire after `ttl` seconds.
+
+    With single_flight enabled, concurrent lookups of the same uncached query wait
+    for one provider call instead of each making their own.
+    """
+
+    def __init__(self, ttl: int = QUERY_CACHE_TTL, max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 single_flight: bool = QUERY_CACHE_SINGLE_FLIGHT):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.single_flight = single_flight
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._ainflight: Dict[str, asyncio.Future] = {}
+
+    def _get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, vector = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def _put(self, key: str, vector: List[float]):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def aget_or_compute(self, model: str, dimensions: int, query: str,
+                              compute: Callable[[str], Awaitable[List[float]]]) -> List[float]:
+        key = cache_key(model, dimensions, query)
+        vector = self._get(key)
+        if vector is not None:
+            return vector
+        if not self.single_flight:
+            vector = await compute(query)
+            self._put(key, vector)
+            return vector
+
+        pending = self._ainflight.get(key)
+        if pending is not None:
+            vector = await asyncio.shield(pending)
+            if vector is not None:
+                return vector
+            # The leader was cancelled before it finished: compute the embedding here instead
+            return await self.aget_or_compute(model, dimensions, query, compute)
+        future = asyncio.get_running_loop().create_future()
+        self._ainflight[key] = future
+        try:
+            vector = await compute(query)
+            self._put(key, vector)
+            future.set_result(vector)
+            return vector
+        except asyncio.CancelledError:
+            # Only the leader's request went away (e.g. its client disconnected); the
+            # waiting followers retry rather than being cancelled along with it
+            future.set_result(None)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure is not logged as "never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._ainflight[key]
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# Shared by every search entry point so repeated queries hit regardless of which path embeds them
+query_embedding_cache = QueryEmbeddingCache()
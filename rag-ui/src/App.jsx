@@ -16,8 +16,14 @@ export default function App() {
       if (!token) return;
 
       try {
-        const res = await api.get(`/list_documents/?user_id=${token}`);
-        setUploadedFiles(res.data.files || []);
+        const files = [];
+        let cursor = null;
+        do {
+          const res = await api.get('/list_documents/', { params: cursor ? { cursor } : {} });
+          files.push(...(res.data.files || []));
+          cursor = res.data.next_cursor;
+        } while (cursor);
+        setUploadedFiles(files);
       } catch (err) {
         console.error('Error fetching files:', err);
       }
@@ -28,20 +28,42 @@ export default function Chat() {
     form.append("user_id", token);
 
     try {
-      const ENDPOINT = "/query/";
-      const res = await api.post(ENDPOINT, form);
-      setAnswer(res.data.answer);
+      const ENDPOINT = "/query/stream";
+      const res = await fetch(`${api.defaults.baseURL}${ENDPOINT}`, {
+        method: 'POST',
+        headers: { Authorization: `Bearer ${token}` },
+        body: form,
+      });
+      if (!res.ok) {
+        throw new Error(`HTTP ${res.status}`);
+      }
 
-      // Typewriter effect
-      let i = 0;
-      function typeWriter() {
-        setDisplayedAnswer(res.data.answer.slice(0, i));
-        if (i < res.data.answer.length) {
-          i++;
-          setTimeout(typeWriter, 15); // Adjust speed here
+      // Render tokens as the server streams them (Server-Sent Events)
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let text = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const raw of events) {
+          const event = raw.match(/^event: (.*)$/m)?.[1];
+          const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || '{}');
+          if (event === 'token') {
+            text += data.token;
+          } else if (event === 'done') {
+            text = data.answer;
+          } else if (event === 'error') {
+            throw new Error(data.error);
+          }
+          setAnswer(text);
+          setDisplayedAnswer(text);
+          setLoading(false);
         }
       }
-      typeWriter();
     } catch (err) {
       setAnswer("❌ Error processing your query.");
       setDisplayedAnswer("❌ Error processing your query.");
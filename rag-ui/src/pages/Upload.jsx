@@ -2,6 +2,18 @@ import { useState } from 'react';
 import api from '../api';
 import FileList from '../components/FileList';
 
+const JOB_POLL_MS = 1000;
+
+async function waitForJob(jobId) {
+  while (true) {
+    const res = await api.get(`/jobs/${jobId}`);
+    if (res.data.status === 'completed') {
+      return res.data;
+    }
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_MS));
+  }
+}
+
 export default function Upload({ files, setFiles, uploadedFiles, setUploadedFiles }) {
   const [message, setMessage] = useState('');
   const [loading, setLoading] = useState(false);
@@ -22,8 +34,11 @@ export default function Upload({ files, setFiles, uploadedFiles, setUploadedFile
     setLoading(true);
     try {
       const res = await api.post('/upload/', formData);
-      setMessage(`✅ Uploaded ${files.length} file(s)`);
-      setUploadedFiles(prev => [...prev, ...(res.data.uploads || [])]);
+      setMessage(`⏳ Indexing ${files.length} file(s)...`);
+      const job = await waitForJob(res.data.job_id);
+      const indexed = job.files.filter(f => f.status === 'indexed');
+      setMessage(`✅ Uploaded ${indexed.length} of ${job.files.length} file(s)`);
+      setUploadedFiles(prev => [...prev, ...indexed]);
       setFiles([]);
     } catch (err) {
       setMessage(`❌ Failed to upload files`);
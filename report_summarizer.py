@@ -1,3 +1,17 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+RANGE_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(-?\d+(?:\.\d+)?)\s*$")
+BOUND_PATTERN = re.compile(r"^\s*([<>])\s*=?\s*(-?\d+(?:\.\d+)?)\s*$")
+
+LOW = -1
+NORMAL = 0
+HIGH = 1
+
+
 def summarize_report(patient_name: str, structured_data: list, risk_profile: dict, tone: str = "patient") -> str:
     lines = []
 
@@ -18,22 +32,15 @@ def summarize_report(patient_name: str, structured_data: list, risk_profile: dic
         for area, level in risk_profile.items():
             lines.append(f"- {area.title()} risk: {level}")
 
-    abnormal_tests = []
-    for panel in structured_data:
-        for test in panel["tests"]:
-            try:
-                val = float(test["value"])
-                ref = test["ref_range"]
-                if ref and ("-" in ref or ">" in ref or "<" in ref):
-                    low, high = parse_range(ref)
-                    if not (low <= val <= high):
-                        abnormal_tests.append(f"{test['name']} = {test['value']} {test['unit']} (Ref: {ref})")
-            except:
-                continue
+    tests = [test for panel in structured_data for test in panel["tests"]]
+    abnormal_tests = [
+        f"{_test_name(test)} = {test['value']} {test['unit']} (Ref: {test['ref_range']})"
+        for test in most_abnormal(tests, evaluate_tests(tests), limit=3)
+    ]
 
     if abnormal_tests:
         lines.append("\nNotable test values:")
-        for line in abnormal_tests[:3]:
+        for line in abnormal_tests:
             lines.append(f"- {line}")
     else:
         lines.append("\nAll tested values appear to be within the normal range.")
@@ -41,12 +48,72 @@ def summarize_report(patient_name: str, structured_data: list, risk_profile: dic
     return "\n".join(lines)
 
 
-def parse_range(range_str):
-    if " - " in range_str:
-        low, high = range_str.split(" - ")
-        return float(low.strip()), float(high.strip())
-    elif ">" in range_str:
-        return float(range_str.strip(" >")), float("inf")
-    elif "<" in range_str:
-        return float("-inf"), float(range_str.strip(" <"))
-    return 0.0, float("inf")
+@lru_cache(maxsize=4096)
+def parse_range(range_str: str) -> Optional[Tuple[float, float]]:
+    """(low, high) of a reference range such as "12 - 16", ">40" or "<200"; None if it isn't one.
+
+    Memoized: the same few hundred range strings repeat across every report.
+    """
+    match = RANGE_PATTERN.match(range_str)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    match = BOUND_PATTERN.match(range_str)
+    if match:
+        bound = float(match.group(2))
+        return (bound, float("inf")) if match.group(1) == ">" else (float("-inf"), bound)
+    return None
+
+
+def _test_name(test: Dict) -> str:
+    return test.get("name") or test.get("test_name", "")
+
+
+def _to_float(value) -> float:
+    try:
+        return float(str(value).strip(" <>"))
+    except ValueError:
+        return np.nan
+
+
+def evaluate_tests(tests: List[Dict]) -> Dict[str, np.ndarray]:
+    """Evaluate test results against their reference ranges in one pass of array operations.
+
+    Accepts both panel tests ({"name", "value", "ref_range"}) and stored lab results
+    ({"test_name", "value", "ref_range"}), so a whole history can be evaluated at once.
+    Returns arrays aligned with `tests`: value, low, high, status (LOW / NORMAL / HIGH)
+    and deviation, the distance outside the range in units of the range width (or of
+    the bound, for one-sided ranges); 0 for normal values and for tests without a
+    numeric value or usable range.
+    """
+    count = len(tests)
+    try:
+        values = np.fromiter((test["value"] for test in tests), dtype=np.float64, count=count)
+    except (TypeError, ValueError):
+        values = np.array([_to_float(test["value"]) for test in tests], dtype=np.float64)
+
+    ranges, inverse = np.unique([test.get("ref_range") or "" for test in tests], return_inverse=True)
+    bounds = np.array([parse_range(r) or (np.nan, np.nan) for r in ranges], dtype=np.float64).reshape(-1, 2)
+    low = bounds[inverse, 0]
+    high = bounds[inverse, 1]
+
+    with np.errstate(invalid="ignore"):
+        status = np.where(values < low, LOW, np.where(values > high, HIGH, NORMAL))
+        width = np.where(np.isfinite(high - low), high - low, np.where(np.isfinite(low), np.abs(low), np.abs(high)))
+        width = np.where(width > 0, width, 1.0)
+        deviation = np.where(status == LOW, low - values, np.where(status == HIGH, values - high, 0.0)) / width
+    return {
+        "value": values,
+        "low": low,
+        "high": high,
+        "status": status,
+        "deviation": np.nan_to_num(deviation),
+    }
+
+
+def most_abnormal(tests: List[Dict], evaluation: Dict[str, np.ndarray], limit: Optional[int] = None) -> List[Dict]:
+    """Out-of-range tests, largest relative deviation first."""
+    abnormal = np.flatnonzero(evaluation["status"] != NORMAL)
+    ranked = abnormal[np.argsort(-evaluation["deviation"][abnormal], kind="stable")]
+    if limit is not None:
+        ranked = ranked[:limit]
+    return [tests[i] for i in ranked]
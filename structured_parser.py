@@ -1,12 +1,185 @@
 import re
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+TEST_PATTERN = re.compile(r"(?P<name>[A-Za-z \(\)\-]+)[^\d]*(?P<value>\d+\.?\d*)\s*(?P<unit>[a-zA-Z\/\%\^\d]+)")
+
+# One result row: name, value, optional H/L flag, optional unit, optional reference range
+LAB_ROW_PATTERN = re.compile(
+    r"^(?P<name>[A-Za-z][A-Za-z0-9 ,\(\)\-/\.%]*?[A-Za-z0-9\)%])\s*[:\-]?\s+"
+    r"(?P<value>[<>]?\s*\d+(?:\.\d+)?)\s*"
+    r"(?:(?P<flag>[HL])\b\s*)?"
+    r"(?P<unit>(?:[a-zA-Zµμ%][a-zA-Zµμ%/\^\d\.\*]*|10\^\d+/[a-zA-Zµμ]+))?\s*"
+    r"(?P<range>\d+(?:\.\d+)?\s*-\s*\d+(?:\.\d+)?|[<>]=?\s*\d+(?:\.\d+)?)?\s*$"
+)
+NAME_ONLY_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9 ,\(\)\-/\.%]*$")
+VALUE_START_PATTERN = re.compile(r"^[<>]?\s*\d")
+# The cells that may follow a row's value cell, in order: flag, unit, reference range
+FLAG_CELL_PATTERN = re.compile(r"^[HL]$")
+UNIT_CELL_PATTERN = re.compile(r"^(?:[a-zA-Zµμ%][a-zA-Zµμ%/\^\d\.\*]*|10\^\d+/[a-zA-Zµμ]+)$")
+RANGE_CELL_PATTERN = re.compile(r"^(?:\d+(?:\.\d+)?\s*-\s*\d+(?:\.\d+)?|[<>]=?\s*\d+(?:\.\d+)?)$")
+RANGE_IN_NAME_PATTERN = re.compile(r"\d+(?:\.\d+)?\s*-\s*\d")
+PAGE_FOOTER_PATTERN = re.compile(r"^page\s+\d+\s+of\b", re.IGNORECASE)
+# Units without a "/", "%" or "^" that would otherwise pass for a one-word test name
+BARE_UNITS = {"fl", "pg", "ng", "mg", "g", "gm", "iu", "u", "mm", "sec", "secs", "ratio"}
+HEADER_WORDS = {"test name", "test", "age", "result", "results", "value", "unit", "units",
+                "reference range", "biological reference interval", "method", "page"}
+REPORT_DATE_PATTERN = re.compile(
+    r"(?:report(?:ed)?|collect(?:ed|ion)|sample|sampling|test|receiv(?:ed)?)\s*(?:date|on)?\s*(?:&\s*time)?\s*[:\-]?\s*"
+    r"(?P<date>\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4}|\d{4}-\d{2}-\d{2}|\d{1,2}[\s\-][A-Za-z]{3,9}[\s\-,]+\d{4})",
+    re.IGNORECASE,
+)
+DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y", "%Y-%m-%d",
+                "%d %b %Y", "%d-%b-%Y", "%d %B %Y", "%d-%B-%Y", "%d %b, %Y", "%d %B, %Y")
+# Words too generic to pick out a test when a question doesn't name one in full
+QUESTION_STOPWORDS = {"the", "and", "how", "has", "have", "had", "was", "were", "been", "what", "when", "did",
+                      "does", "over", "time", "from", "with", "my", "level", "levels", "value", "values",
+                      "count", "test", "tests", "total", "serum", "blood", "trend", "changed", "change",
+                      "report", "reports", "result", "results", "last", "year", "years", "month", "months"}
+# Words of normalized units ("mg dl", "cells cmm"), never part of a test name
+UNIT_WORDS = {"mg", "dl", "g", "gm", "ml", "l", "ul", "fl", "pg", "ng", "iu", "miu", "uiu", "u", "mmol", "umol",
+              "meq", "cells", "cmm", "mill", "mm", "hr", "sec", "secs", "%"}
+_WHITESPACE = re.compile(r"\s+")
+_NON_KEY = re.compile(r"[^a-z0-9%]+")
+
 
 def extract_structured_tests(text: str) -> list:
-    pattern = r"(?P<name>[A-Za-z \(\)\-]+)[^\d]*(?P<value>\d+\.?\d*)\s*(?P<unit>[a-zA-Z\/\%\^\d]+)"
     results = []
-    for match in re.finditer(pattern, text):
+    for match in TEST_PATTERN.finditer(text):
         results.append({
             "test_name": match.group("name").strip(),
             "value": float(match.group("value")),
             "unit": match.group("unit")
         })
     return results
+
+
+def normalize_test_name(name: str) -> str:
+    """Key under which the same test from different reports lines up, e.g. "HbA1c" / "HBA1C"."""
+    return _NON_KEY.sub(" ", name.lower()).strip()
+
+
+def is_test_key(key: str) -> bool:
+    """Whether a stored key names a test, not a unit or a range read as one by an older parse."""
+    words = key.split()
+    return bool(words) and words[0] not in UNIT_WORDS and not any(
+        a.isdigit() and b.isdigit() for a, b in zip(words, words[1:]))
+
+
+def _name_words(key: str) -> set:
+    return {w for w in key.split() if not w.isdigit() and w not in UNIT_WORDS}
+
+
+def find_named_tests(question: str, test_keys: List[str]) -> List[str]:
+    """Test keys a question names in full ("hba1c", "ldl cholesterol")."""
+    padded = f" {' '.join(normalize_test_name(question).split())} "
+    return [key for key in test_keys if is_test_key(key) and f" {key} " in padded]
+
+
+def find_tests_by_word(question: str, test_keys: List[str]) -> List[str]:
+    """Test keys sharing a distinctive word of the test name with a question ("cholesterol" ->
+    every cholesterol test). Units and numbers in a key never match."""
+    distinctive = {w for w in normalize_test_name(question).split()
+                   if len(w) >= 3 and w not in QUESTION_STOPWORDS and w not in UNIT_WORDS}
+    return [key for key in test_keys if is_test_key(key) and distinctive.intersection(_name_words(key))]
+
+
+def find_mentioned_tests(question: str, test_keys: List[str]) -> List[str]:
+    """Test keys a question names in full or, failing that, by a distinctive word of the name."""
+    return find_named_tests(question, test_keys) or find_tests_by_word(question, test_keys)
+
+
+def find_report_date(text: str) -> Optional[datetime]:
+    for match in REPORT_DATE_PATTERN.finditer(text):
+        raw = _WHITESPACE.sub(" ", match.group("date")).strip()
+        for fmt in DATE_FORMATS:
+            try:
+                return datetime.strptime(raw, fmt)
+            except ValueError:
+                continue
+    return None
+
+
+def is_unit(text: str) -> bool:
+    """Whether a cell is a unit ("mg/dL", "%", "fL") rather than a test name."""
+    return bool(UNIT_CELL_PATTERN.match(text)) and (any(c in text for c in "/%^") or text.lower() in BARE_UNITS)
+
+
+def _row_end(lines: List[str], i: int) -> int:
+    """End of the table row whose name cell is lines[i] and value cell lines[i + 1]: the
+    optional flag, unit and range cells after the value, stopping at anything else."""
+    end = i + 2
+    for accepts in (FLAG_CELL_PATTERN.match, is_unit, RANGE_CELL_PATTERN.match):
+        if end < len(lines) and accepts(lines[end]):
+            end += 1
+    return end
+
+
+def _candidate_rows(text: str):
+    lines = [_WHITESPACE.sub(" ", line).strip() for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    for i, line in enumerate(lines):
+        yield line
+        # Table cells often come out of the PDF one per line: rebuild "name value flag unit range",
+        # never reaching into the next row and never starting on a unit cell
+        if (NAME_ONLY_PATTERN.match(line) and not is_unit(line)
+                and i + 1 < len(lines) and VALUE_START_PATTERN.match(lines[i + 1])):
+            end = _row_end(lines, i)
+            for width in range(end - i, 1, -1):
+                yield " ".join(lines[i:i + width])
+
+
+def extract_lab_results(chunks: List[str], report_date: Optional[datetime] = None) -> List[Dict]:
+    """Lab result rows (test_name, test_key, value, unit, ref_range, flag, report_date) of one report.
+
+    Rows repeated across chunks, like a panel printed on two pages, are kept once.
+    """
+    names, values, units, ranges, flags = [], [], [], [], []
+    for chunk in chunks:
+        taken = set()
+        for row in _candidate_rows(chunk):
+            match = LAB_ROW_PATTERN.match(row)
+            if match is None:
+                continue
+            name = match.group("name").strip()
+            if (name.lower() in HEADER_WORDS or is_unit(name) or RANGE_IN_NAME_PATTERN.search(name)
+                    or PAGE_FOOTER_PATTERN.match(row)
+                    or (name, match.group("value")) in taken):
+                continue
+            # Prefer the longest reading of a row rebuilt from table cells
+            taken.add((name, match.group("value")))
+            names.append(name)
+            values.append(match.group("value"))
+            units.append(match.group("unit") or "")
+            ranges.append(_WHITESPACE.sub(" ", (match.group("range") or "").replace(" - ", "-").replace("-", " - ")).strip())
+            flags.append(match.group("flag") or "")
+    if not names:
+        return []
+
+    # Column-wise post-processing over the whole report
+    numeric = np.char.replace(np.char.replace(np.char.replace(np.array(values), "<", ""), ">", ""), " ", "")
+    parsed = numeric.astype(np.float64)
+    keys = np.array([normalize_test_name(name) for name in names])
+    _, first = np.unique(np.stack([keys, numeric, np.array(units)], axis=1), axis=0, return_index=True)
+    return [
+        {
+            "test_name": names[i],
+            "test_key": str(keys[i]),
+            "value": float(parsed[i]),
+            "unit": units[i],
+            "ref_range": ranges[i],
+            "flag": flags[i],
+            "report_date": report_date,
+        }
+        for i in np.sort(first)
+    ]
+
+
+def parse_lab_report(full_text: str, fallback_date: Optional[datetime] = None) -> List[Dict]:
+    """Lab rows of one uploaded report, dated by the report itself when it states a date.
+
+    Parsed from the full text, so rows are never cut at chunk boundaries or read twice from overlaps.
+    """
+    return extract_lab_results([full_text], find_report_date(full_text) or fallback_date)
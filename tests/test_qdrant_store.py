@@ -0,0 +1,37 @@
+import asyncio
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import PointStruct
+
+import qdrant_store
+
+
+def test_reupload_replaces_points_with_integer_ids(monkeypatch):
+    """Points indexed before content-derived ids have integer ids; a re-upload deletes them."""
+    monkeypatch.setattr(qdrant_store, "client", AsyncQdrantClient(location=":memory:"))
+    monkeypatch.setattr(qdrant_store, "EMBED_DIM", 4)
+    monkeypatch.setattr(qdrant_store, "_collection_ready", False)
+    monkeypatch.setattr(qdrant_store, "truncate_with_token_count", lambda text: (text, len(text.split())))
+
+    async def fake_embeddings(texts, token_counts, priority=None):
+        return [[1.0, 0.0, 0.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(qdrant_store, "get_embeddings", fake_embeddings)
+
+    async def run():
+        await qdrant_store.init_collection()
+        payload = {"user_id": "u1", "filename": "report.pdf", "patient_id": "p", "text": "old"}
+        await qdrant_store.client.upsert(
+            collection_name=qdrant_store.COLLECTION,
+            points=[PointStruct(id=123456789012 + i, vector=[0.0, 1.0, 0.0, 0.0], payload=payload) for i in range(2)],
+        )
+        assert await qdrant_store.indexed_point_ids("u1", "report.pdf") == {123456789012, 123456789013}
+
+        await qdrant_store.upsert_chunks("p", "report.pdf", ["first chunk", "second chunk"], "u1")
+        return await qdrant_store.indexed_point_ids("u1", "report.pdf")
+
+    ids = asyncio.run(run())
+    assert ids == {qdrant_store.chunk_point_id("u1", "report.pdf", chunk) for chunk in ["first chunk", "second chunk"]}
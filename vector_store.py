@@ -2,42 +2,72 @@ import asyncio
 import logging
 import hashlib
 import re
+import uuid
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, Filter, FieldCondition, MatchValue
-import openai
-import google.generativeai as genai
+from qdrant_client.models import (
+    PointStruct, Filter, FieldCondition, MatchValue,
+    SparseVector, SparseVectorParams, NamedSparseVector, SearchRequest
+)
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+
+from bm25_index import BM25Index, to_sparse
+from embedding_cache import EmbeddingCache
+from embedding_providers import create_provider
+from query_cache import query_embedding_cache
 
 logger = logging.getLogger(__name__)
 
+SPARSE_VECTOR_NAME = "text"
+
 class VectorStore:
     """Simple vector store implementation"""
     
-    def __init__(self, config):
+    def __init__(self, config, client=None, embedder=None):
         self.config = config
-        self.client = QdrantClient(
+        self.client = client or QdrantClient(
             host=config.qdrant_host,
             port=config.qdrant_port
         )
         self.collection_name = config.collection_name
         
         # Initialize embeddings
-        if config.embedding_provider == "openai":
-            openai.api_key = config.openai_api_key
+        if embedder is not None:
+            self.embedder = embedder
+        elif config.embedding_provider == "openai":
+            self.embedder = create_provider(
+                "openai", config.openai_embedding_model, config.embedding_dimensions,
+                api_key=config.openai_api_key
+            )
+        elif config.embedding_provider == "gemini":
+            self.embedder = create_provider("gemini", config.gemini_model, api_key=config.gemini_api_key)
         else:
-            genai.configure(api_key=config.gemini_api_key)
+            self.embedder = create_provider(config.embedding_provider)
+        self.embedding_dimensions = self.embedder.dimensions
+        self.embedding_cache = EmbeddingCache(
+            config.embedding_cache_path,
+            config.embedding_cache_max_entries
+        )
+        self.query_cache = query_embedding_cache
+        self.query_cache.ttl = config.cache_ttl
         
-        # TF-IDF for keyword search
-        self.tfidf_vectorizer = TfidfVectorizer(max_features=1000, ngram_range=(1, 2))
-        self.tfidf_matrix = None
-        self.document_ids = []
+        # BM25 for keyword search, partitioned by tenant and persisted on disk
+        self.keyword_index = BM25Index(config.keyword_index_dir)
+        self.partition_key = config.keyword_partition_key
+        self.hybrid_mode = config.hybrid_mode
         
         # Create collection
         self._init_collection()
+        if self.hybrid_mode == "sparse" and not self._has_sparse_vectors():
+            logger.warning(
+                f"Collection {self.collection_name} has no '{SPARSE_VECTOR_NAME}' sparse vectors, "
+                "falling back to local keyword search"
+            )
+            self.hybrid_mode = "local"
+        if self.keyword_index.is_empty():
+            self._rebuild_keyword_index()
     
     def _init_collection(self):
         """Initialize Qdrant collection"""
@@ -56,9 +86,13 @@ class VectorStore:
                 self.client.create_collection(
                     collection_name=self.collection_name,
                     vectors_config={
-                        "size": self.config.embedding_dimensions,
+                        "size": self.embedding_dimensions,
                         "distance": "Cosine"
-                    }
+                    },
+                    sparse_vectors_config=(
+                        {SPARSE_VECTOR_NAME: SparseVectorParams()}
+                        if self.hybrid_mode == "sparse" else None
+                    )
                 )
                 logger.info(f"Created collection: {self.collection_name}")
             else:
@@ -68,26 +102,22 @@ class VectorStore:
             logger.error(f"Error initializing collection: {e}")
             # Continue anyway - collection might already exist
     
+    def _has_sparse_vectors(self):
+        """Whether the collection stores the lexical sparse vector next to the dense one"""
+        try:
+            params = self.client.get_collection(self.collection_name).config.params
+            return SPARSE_VECTOR_NAME in (params.sparse_vectors or {})
+        except Exception as e:
+            logger.warning(f"Error reading collection config: {e}")
+            return False
+    
+    def _embedding_model_name(self):
+        """Name of the model embed_text calls, used to key the embedding cache"""
+        return self.embedder.model
+    
     async def embed_text(self, text):
         """Generate embeddings for text"""
-        if self.config.embedding_provider == "openai":
-            response = await asyncio.to_thread(
-                openai.embeddings.create,
-                model=self.config.openai_embedding_model,
-                input=text
-            )
-            embedding = response.data[0].embedding
-        else:
-            model_name = self.config.gemini_model
-            if not (model_name.startswith("models/") or model_name.startswith("tunedModels/")):
-                model_name = "models/embedding-001"
-            result = await asyncio.to_thread(
-                genai.embed_content,
-                model=model_name,
-                content=text,
-                task_type="retrieval_document"
-            )
-            embedding = result['embedding']
+        embedding = await self.embedder.embed_one(text)
         # Normalize
         norm = np.linalg.norm(embedding)
         if norm > 0:
@@ -98,24 +128,51 @@ class VectorStore:
         """Add documents to vector store"""
         logger.info(f"Adding {len(documents)} documents")
         
+        # Reuse cached embeddings, only call the provider for unseen content
+        model_name = self._embedding_model_name()
+        dims = self.embedding_dimensions
+        contents = [doc["content"] for doc in documents]
+        embeddings = await asyncio.to_thread(self.embedding_cache.get_many, model_name, dims, contents)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # One call for all of them, so the provider can batch
+            vectors = await self.embedder.embed([contents[i] for i in missing])
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = vector
+            await asyncio.to_thread(
+                self.embedding_cache.put_many,
+                model_name,
+                dims,
+                [contents[i] for i in missing],
+                [embeddings[i] for i in missing]
+            )
+        
         points = []
+        indexed = []
         for i, doc in enumerate(documents):
-            # Generate embedding
-            embedding = await self.embed_text(doc["content"])
+            embedding = embeddings[i]
             
             # Create point
-            point_id = hashlib.md5(f"{doc['metadata']['file_hash']}_{i}".encode()).hexdigest()
+            point_id = str(uuid.UUID(hashlib.md5(f"{doc['metadata']['file_hash']}_{i}".encode()).hexdigest()))
             
+            payload = {
+                **doc["metadata"],
+                "content": doc["content"],
+                "indexed_at": datetime.utcnow().isoformat()
+            }
+            vector = embedding
+            if self.hybrid_mode == "sparse":
+                indices, values = to_sparse(
+                    self.keyword_index.document_weights(self._partition_of(payload), doc["content"])
+                )
+                vector = {"": embedding, SPARSE_VECTOR_NAME: SparseVector(indices=indices, values=values)}
             point = PointStruct(
                 id=point_id,
-                vector=embedding,
-                payload={
-                    **doc["metadata"],
-                    "content": doc["content"],
-                    "indexed_at": datetime.utcnow().isoformat()
-                }
+                vector=vector,
+                payload=payload
             )
             points.append(point)
+            indexed.append((point_id, payload))
             
             # Batch upload
             if len(points) >= 100:
@@ -132,15 +189,20 @@ class VectorStore:
                 points=points
             )
         
-        # Update TF-IDF
-        await self._update_tfidf()
+        # Update keyword index
+        await asyncio.to_thread(self._index_keywords, indexed)
         
         logger.info("Documents added successfully")
     
     async def hybrid_search(self, query, filter_conditions=None, top_k=5):
         """Perform hybrid search"""
         # Vector search
-        query_embedding = await self.embed_text(query)
+        query_embedding = await self.query_cache.aget_or_compute(
+            self._embedding_model_name(),
+            self.embedding_dimensions,
+            query,
+            self.embed_text
+        )
         
         search_filter = None
         if filter_conditions:
@@ -149,51 +211,133 @@ class VectorStore:
                 conditions.append(FieldCondition(key=key, match=MatchValue(value=value)))
             search_filter = Filter(must=conditions)
         
-        vector_results = self.client.search(
-            collection_name=self.collection_name,
-            query_vector=query_embedding,
-            query_filter=search_filter,
-            limit=top_k * 2
-        )
-        
-        # Keyword search
-        keyword_results = self._keyword_search(query, top_k * 2)
+        if self.hybrid_mode == "sparse":
+            # Dense and lexical search in one Qdrant request, under the same tenant filter
+            partition = (filter_conditions or {}).get(self.partition_key)
+            indices, values = to_sparse(self.keyword_index.query_weights(
+                None if partition is None else str(partition),
+                query
+            ))
+            requests = [
+                SearchRequest(vector=query_embedding, filter=search_filter,
+                              limit=top_k * 2, with_payload=True)
+            ]
+            if indices:
+                requests.append(SearchRequest(
+                    vector=NamedSparseVector(
+                        name=SPARSE_VECTOR_NAME,
+                        vector=SparseVector(indices=indices, values=values)
+                    ),
+                    filter=search_filter,
+                    limit=top_k * 2,
+                    with_payload=True
+                ))
+            vector_results, *sparse_results = self.client.search_batch(
+                collection_name=self.collection_name,
+                requests=requests
+            )
+            keyword_results = [
+                {"id": str(hit.id), "score": hit.score, "payload": hit.payload}
+                for hit in (sparse_results[0] if sparse_results else [])
+                if hit.score > 0
+            ]
+        else:
+            vector_results = self.client.search(
+                collection_name=self.collection_name,
+                query_vector=query_embedding,
+                query_filter=search_filter,
+                limit=top_k * 2
+            )
+            
+            # Keyword search
+            keyword_results = await asyncio.to_thread(self._keyword_search, query, top_k * 2, filter_conditions)
         
         # Combine results
-        combined = self._combine_results(vector_results, keyword_results)
+        if self.config.fusion_method == "rrf":
+            combined = self._rrf_fuse(vector_results, keyword_results)
+        else:
+            combined = self._combine_results(vector_results, keyword_results)
         
         return combined[:top_k]
     
-    def _keyword_search(self, query, limit):
-        """Perform keyword search using TF-IDF"""
-        if self.tfidf_matrix is None:
-            return []
-        
-        query_vector = self.tfidf_vectorizer.transform([query])
-        similarities = (self.tfidf_matrix * query_vector.T).toarray().flatten()
-        
-        top_indices = np.argsort(similarities)[::-1][:limit]
-        
-        results = []
-        for idx in top_indices:
-            if similarities[idx] > 0:
-                point_id = self.document_ids[idx]
-                points = self.client.retrieve(
+    def _partition_of(self, payload):
+        """Keyword index partition (tenant) a payload belongs to"""
+        value = payload.get(self.partition_key)
+        return "" if value is None else str(value)
+    
+    def _index_keywords(self, indexed):
+        """Add (point_id, payload) pairs to the keyword index, grouped by partition"""
+        by_partition = {}
+        for point_id, payload in indexed:
+            by_partition.setdefault(self._partition_of(payload), []).append((point_id, payload))
+        for partition, docs in by_partition.items():
+            self.keyword_index.add(partition, docs)
+    
+    def _rebuild_keyword_index(self):
+        """One-off build of the keyword index from every point already in the collection"""
+        try:
+            offset = None
+            total = 0
+            while True:
+                batch, offset = self.client.scroll(
                     collection_name=self.collection_name,
-                    ids=[point_id]
+                    limit=1000,
+                    offset=offset,
+                    with_vectors=False
                 )
-                if points:
-                    results.append({
-                        "id": str(points[0].id),
-                        "score": float(similarities[idx]),
-                        "payload": points[0].payload
-                    })
+                self._index_keywords([(str(p.id), p.payload) for p in batch if p.payload])
+                total += len(batch)
+                if offset is None:
+                    break
+            logger.info(f"Built keyword index from {total} points")
+        except Exception as e:
+            logger.warning(f"Error building keyword index: {e}")
+    
+    def _keyword_search(self, query, limit, filter_conditions=None):
+        """Perform keyword search using BM25, restricted to the filtered tenant"""
+        payload_filter = dict(filter_conditions or {})
+        partition = payload_filter.pop(self.partition_key, None)
+        return self.keyword_index.search(
+            query,
+            None if partition is None else str(partition),
+            limit,
+            payload_filter
+        )
+    
+    def _rrf_fuse(self, vector_results, keyword_results):
+        """Combine vector and keyword results with weighted reciprocal rank fusion"""
+        k = self.config.rrf_k
+        combined = {}
+        for rank, hit in enumerate(vector_results, start=1):
+            combined[str(hit.id)] = {
+                "id": str(hit.id),
+                "content": hit.payload.get("content", ""),
+                "metadata": hit.payload,
+                "vector_score": hit.score,
+                "keyword_score": 0,
+                "combined_score": self.config.vector_weight / (k + rank)
+            }
+        for rank, result in enumerate(keyword_results, start=1):
+            entry = combined.setdefault(result["id"], {
+                "id": result["id"],
+                "content": result["payload"].get("content", ""),
+                "metadata": result["payload"],
+                "vector_score": 0,
+                "keyword_score": 0,
+                "combined_score": 0
+            })
+            entry["keyword_score"] = result["score"]
+            entry["combined_score"] += self.config.keyword_weight / (k + rank)
         
+        results = list(combined.values())
+        results.sort(key=lambda x: x["combined_score"], reverse=True)
         return results
     
     def _combine_results(self, vector_results, keyword_results):
         """Combine vector and keyword search results"""
         combined = {}
+        # BM25 scores are unbounded; scale them to [0, 1] like the cosine scores
+        max_keyword = max((r["score"] for r in keyword_results), default=0) or 1
         value_pattern = re.compile(r'\b\d+\.?\d*\s*(mg/dL|g/dL|mmol/L|IU/L|%|/μL|mmHg|bpm|°[CF])\b', re.IGNORECASE)
         # Add vector results
         for hit in vector_results:
@@ -213,7 +357,7 @@ class VectorStore:
             doc_id = result["id"]
             if doc_id in combined:
                 combined[doc_id]["keyword_score"] = result["score"]
-                combined[doc_id]["combined_score"] += result["score"] * self.config.keyword_weight
+                combined[doc_id]["combined_score"] += result["score"] / max_keyword * self.config.keyword_weight
             else:
                 combined[doc_id] = {
                     "id": doc_id,
@@ -221,7 +365,7 @@ class VectorStore:
                     "metadata": result["payload"],
                     "vector_score": 0,
                     "keyword_score": result["score"],
-                    "combined_score": result["score"] * self.config.keyword_weight
+                    "combined_score": result["score"] / max_keyword * self.config.keyword_weight
                 }
         
         # Sort by combined score
@@ -230,18 +374,6 @@ class VectorStore:
         
         return results
     
-    async def _update_tfidf(self):
-        """Update TF-IDF matrix"""
-        all_points = self.client.scroll(
-            collection_name=self.collection_name,
-            limit=10000
-        )[0]
-        
-        if all_points:
-            texts = [p.payload.get("content", "") for p in all_points]
-            self.document_ids = [p.id for p in all_points]
-            self.tfidf_matrix = self.tfidf_vectorizer.fit_transform(texts)
-    
     async def get_document_by_filename(self, filename):
         """Get all chunks for a document"""
         results = self.client.scroll(
@@ -268,7 +400,11 @@ class VectorStore:
                 points_selector={"points": point_ids}
             )
             logger.info(f"Deleted {len(point_ids)} chunks for {filename}")
-            await self._update_tfidf()
+            by_partition = {}
+            for c in chunks:
+                by_partition.setdefault(self._partition_of(c["metadata"]), []).append(c["id"])
+            for partition, ids in by_partition.items():
+                await asyncio.to_thread(self.keyword_index.remove, partition, ids)
     
     async def get_collection_stats(self):
         """Get collection statistics"""
@@ -287,7 +423,7 @@ class VectorStore:
             # Get points count using search with limit 0
             search_result = self.client.search(
                 collection_name=self.collection_name,
-                query_vector=[0.0] * self.config.embedding_dimensions,
+                query_vector=[0.0] * self.embedding_dimensions,
                 limit=0
             )
             